@@ -0,0 +1,8 @@
+"""Benchmarks of itrmicfit on synthetic plates, run them with
+
+    python -m benchmarks.run --compounds 200 --replicates 2
+
+and check the import time of the package (this one fails when a module loads a heavy library) with
+
+    python -m benchmarks.imports
+"""
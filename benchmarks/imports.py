@@ -0,0 +1,63 @@
+"""Check that importing itrmicfit modules stays fast and doesn't load the heavy libraries
+
+    python -m benchmarks.imports
+
+Each module is imported in a fresh interpreter. The exit code is 1 if a module loads one of the libraries it should
+not, so it can run in CI.
+"""
+import argparse
+import subprocess
+import sys
+from typing import List, Optional
+
+import pandas as pd
+
+HEAVY = ["scipy", "openpyxl", "PIL", "matplotlib", "uncertainties"]
+
+# None of them may load the HEAVY libraries when imported, fitting is what the worker processes import
+MODULES = ["itrmicfit", "itrmicfit.fitting", "itrmicfit.batchfitting", "itrmicfit.engine", "itrmicfit.rendering",
+           "itrmicfit.cli", "itrmicfit.jobs", "itrmicfit.sweep"]
+
+PROBE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(seconds)
+print(",".join(name for name in {heavy!r} if name in sys.modules))
+"""
+
+
+def measure(module: str, repeat: int = 3) -> dict:
+    """Best import time of `module` over `repeat` fresh interpreters, and the heavy libraries it loaded"""
+    times = []
+    loaded = ""
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY)],
+                                capture_output=True, text=True, check=True).stdout.split("\n")
+        times.append(float(output[0]))
+        loaded = output[1]
+    return {"module": module, "seconds": min(times), "heavy libraries loaded": loaded}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.imports", description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--max-seconds", type=float, default=None,
+                        help="also fail if importing itrmicfit.fitting takes longer than this")
+    args = parser.parse_args(argv)
+
+    rows = [measure(module, args.repeat) for module in MODULES]
+    print(pd.DataFrame(rows).set_index("module").to_markdown(floatfmt=".3f"))
+
+    failed = [row["module"] for row in rows if row["heavy libraries loaded"]]
+    fitting = next(row for row in rows if row["module"] == "itrmicfit.fitting")
+    if args.max_seconds is not None and fitting["seconds"] > args.max_seconds:
+        failed.append("itrmicfit.fitting (too slow)")
+    if failed:
+        print(f"Failed: {', '.join(failed)}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
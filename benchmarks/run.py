@@ -0,0 +1,104 @@
+"""Time each stage of itrmicfit on a synthetic plate and check the MICs found against the truth
+
+    python -m benchmarks.run --compounds 200 --replicates 2 --configs default batch batch+closed_form
+
+The options of a config are batch, closed_form, initial_guess and piecewise.
+"""
+import argparse
+import io
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from itrmicfit.engine import Engine
+from itrmicfit.fitting import Fit, fit_from_sourcedata
+from itrmicfit.rendering import render_pages
+
+from .synthetic import generate_plate, true_mics, write_raw
+
+CONFIGS = ["default", "batch", "closed_form", "batch+closed_form"]
+
+
+@contextmanager
+def timer(timings: Dict[str, float], stage: str):
+    start = time.perf_counter()
+    yield
+    timings[stage] = time.perf_counter() - start
+
+
+def accuracy(fits: List[Fit], truth: pd.DataFrame, percentage: int) -> Dict[str, float]:
+    """How close the MICs found are to the true ones, errors are in number of dilutions (log2)"""
+    expected = dict(zip(truth.name, true_mics(truth, percentage)))
+    errors = []
+    for fit in fits:
+        if isinstance(fit.mic.concentration, (float, np.floating)) and np.isfinite(expected[fit.name]):
+            errors.append(abs(np.log2(fit.mic.concentration / expected[fit.name])))
+    errors = np.array(errors)
+    return {"determined": len(errors) / len(fits),
+            "within 1 dilution": float(np.mean(errors <= 1)) if len(errors) > 0 else np.nan,
+            "median error": float(np.median(errors)) if len(errors) > 0 else np.nan}
+
+
+def run(path: str, truth: pd.DataFrame, config: str, percentage: int = 90, dilution_factor: float = 2.0,
+        workers: Optional[int] = None, plot: bool = True) -> Dict[str, float]:
+    """Timings of each stage (in seconds) and accuracy of the run of `config` on the plate in `path`"""
+    options = config.split("+")
+    timings: Dict[str, float] = {}
+    engine = Engine()
+    engine.MICn = percentage
+
+    with timer(timings, "load_file"):
+        engine.load_file(path)
+    engine.data.dilution_factor = dilution_factor
+    with timer(timings, "calculate"):
+        engine.data.calculate()
+    with timer(timings, "fit_from_sourcedata"):
+        engine.fits = fit_from_sourcedata(engine.data, percentage / 100, workers=workers, batch="batch" in options,
+                                          closed_form="closed_form" in options,
+                                          initial_guess="initial_guess" in options,
+                                          piecewise="piecewise" in options)
+    with timer(timings, "export_as_dataframe"):
+        engine.export_as_dataframe()
+    with timer(timings, "export_as_spreadsheet"):
+        engine.export_as_spreadsheet(io.BytesIO(), graphics=False)
+    if plot:
+        with timer(timings, "plot"):
+            render_pages(engine.fits, workers=workers, cache=None)
+
+    return {"config": config, **timings, "total": sum(timings.values()),
+            **accuracy(engine.fits, truth, percentage)}
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run", description=__doc__.splitlines()[0])
+    parser.add_argument("--compounds", type=int, default=96)
+    parser.add_argument("--replicates", type=int, default=2)
+    parser.add_argument("--noise", type=float, default=0.03, help="standard deviation of the noise on the growth")
+    parser.add_argument("--mic", type=int, default=90, help="MIC percentage")
+    parser.add_argument("--dilution-factor", type=float, default=2.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None, help="number of processes (default: none)")
+    parser.add_argument("--configs", nargs="+", default=CONFIGS,
+                        help=f"fitting options to compare, options are combined with + (default: {' '.join(CONFIGS)})")
+    parser.add_argument("--no-plot", action="store_true", help="do not time the rendering of the graphics")
+    parser.add_argument("--keep", help="save the generated plate at this path")
+    args = parser.parse_args(argv)
+
+    plate, truth = generate_plate(args.compounds, args.replicates, args.noise, args.dilution_factor, args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.keep or os.path.join(directory, "plate.xlsx")
+        write_raw(plate, path)
+        rows = [run(path, truth, config, args.mic, args.dilution_factor, args.workers, not args.no_plot)
+                for config in args.configs]
+
+    print(f"{args.compounds} compounds, {args.replicates} replicates, noise {args.noise}, MIC{args.mic}")
+    print(pd.DataFrame(rows).set_index("config").to_markdown(floatfmt=".3f"))
+
+
+if __name__ == "__main__":
+    main()
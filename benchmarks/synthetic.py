@@ -0,0 +1,58 @@
+"""Synthetic plates in the RAW format, generated from known Hill 4p parameters"""
+from typing import Tuple
+
+import numpy as np
+import openpyxl
+import pandas as pd
+
+from itrmicfit.engine import Engine
+from itrmicfit.fitting import hill_4p_function, hill_4p_inverse
+
+BLANK = 330.0
+CONTROL = 5000.0
+
+
+def generate_plate(compounds: int = 96, replicates: int = 2, noise: float = 0.03, dilution_factor: float = 2.0,
+                   seed: int = 0) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """A plate of `compounds` substances measured `replicates` times, with a gaussian noise of standard deviation
+    `noise` on the normalized growth.
+
+    Returns the plate (with the Engine.DEFAULT_COLUMNS) and the truth: the Hill 4p parameters of each substance."""
+    rng = np.random.default_rng(seed)
+    names = [f"c{index:05d}" for index in range(compounds)]
+    initial_concentrations = rng.choice([1.0, 2.0, 4.0, 8.0, 10.0, 16.0, 32.0], compounds)
+    x = initial_concentrations[:, np.newaxis] / dilution_factor ** np.arange(9)
+    # d0i is kept well inside the measured range, so that the MICs can be measured
+    d0i = initial_concentrations * np.exp(rng.uniform(np.log(0.02), np.log(0.3), compounds))
+    n = rng.uniform(1.0, 5.0, compounds)
+    s = rng.uniform(0.9, 1.1, compounds)
+    o = rng.uniform(0.01, 0.05, compounds)
+    growth = hill_4p_function(x, d0i[:, np.newaxis], n[:, np.newaxis], s[:, np.newaxis], o[:, np.newaxis])
+
+    rows = []
+    for replicate in range(replicates):
+        measured = growth + rng.normal(0, noise, growth.shape)
+        blanks = BLANK + rng.normal(0, 5, (compounds, 2))
+        values = blanks.mean(axis=1)[:, np.newaxis] + measured * (CONTROL - blanks.mean(axis=1)[:, np.newaxis])
+        for index in range(compounds):
+            rows.append([blanks[index, 0], *values[index], CONTROL, blanks[index, 1], names[index],
+                         initial_concentrations[index]])
+    plate = pd.DataFrame(rows, columns=Engine.DEFAULT_COLUMNS)
+
+    truth = pd.DataFrame({"name": names, "initial_concentration": initial_concentrations,
+                          "d0i": d0i, "n": n, "s": s, "o": o})
+    return plate, truth
+
+
+def true_mics(truth: pd.DataFrame, percentage: int) -> np.ndarray:
+    """MIC of each substance of `truth` for the MIC `percentage`, NaN where the curve never reaches it"""
+    return hill_4p_inverse(1 - percentage / 100, truth.d0i.values, truth.n.values, truth.s.values, truth.o.values)
+
+
+def write_raw(plate: pd.DataFrame, path: str):
+    """Write the plate as a "RAW" sheet that Engine.load_file reads"""
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("RAW")
+    for row in plate.to_numpy(dtype=object).tolist():
+        ws.append(row)
+    wb.save(path)
@@ -1 +1,19 @@
+"""Fitting of Hill 4p curves to plate data to estimate MICs
 
+The submodules are imported when they are first used (itrmicfit.engine, itrmicfit.fitting…), importing the package
+itself loads nothing else. Heavy libraries (scipy, openpyxl, PIL, matplotlib, uncertainties) are only imported by
+the functions that need them."""
+import importlib
+
+SUBMODULES = ["batchfitting", "cache", "cli", "engine", "fitting", "jobs", "plotting", "profiling", "rendering",
+              "sourcedata", "sweep"]
+
+
+def __getattr__(name: str):
+    if name in SUBMODULES:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + SUBMODULES)
@@ -0,0 +1,268 @@
+import numpy as np
+from typing import List, Optional, Tuple
+
+HILL_4P_LOWER = (0.0001, 0.01, 0.01)  # lower bounds of n, s and o, d0i is bound by the measured range
+HILL_4P_UPPER = (6, 4, 1)  # upper bounds of n, s and o
+
+
+def hill_4p_bounds(x):
+    """Bounds (lower, upper), each (N, 4), of the Hill 4p fit of each row of `x`, those of `fitting.fit_hill_4p`
+    too"""
+    lower = np.empty((x.shape[0], 4))
+    upper = np.empty((x.shape[0], 4))
+    lower[:, 0] = x.min(axis=1)
+    upper[:, 0] = x.max(axis=1)
+    lower[:, 1:] = HILL_4P_LOWER
+    upper[:, 1:] = HILL_4P_UPPER
+    return lower, upper
+
+
+def hill_4p_initial_guess(x, y) -> np.ndarray:
+    """Starting parameters (N, 4) for the Hill 4p fit of the curves `x` and `y` (N, m), estimated from the data
+
+    o and s come from the plateaus, the mean of the points of the highest and lowest concentrations. d0i (where
+    the growth is halfway between them) and n come from a linear regression of log(s / (y - o) - 1) on log(x),
+    over the points that are not on a plateau. The guesses are kept inside the bounds of the fit."""
+    x = np.atleast_2d(np.asarray(x, dtype=float))
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    lower, upper = hill_4p_bounds(x)
+    order = np.argsort(x, axis=1)
+    xs = np.take_along_axis(x, order, axis=1)
+    ys = np.take_along_axis(y, order, axis=1)
+    edge = max(1, x.shape[1] // 6)
+    o = np.clip(ys[:, -edge:].mean(axis=1), lower[:, 3], upper[:, 3])
+    s = np.clip(ys[:, :edge].mean(axis=1) - o, lower[:, 2], upper[:, 2])
+
+    with np.errstate(all="ignore"):
+        fraction = (ys - o[:, np.newaxis]) / s[:, np.newaxis]
+        informative = (fraction > 0.05) & (fraction < 0.95) & (xs > 0)
+        weights = informative.astype(float)
+        count = weights.sum(axis=1)
+        log_x = np.where(informative, np.log(xs), 0.0)
+        logit = np.where(informative, np.log(1 / fraction - 1), 0.0)
+        mean_x = (weights * log_x).sum(axis=1) / count
+        mean_logit = (weights * logit).sum(axis=1) / count
+        covariance = (weights * (log_x - mean_x[:, np.newaxis]) * (logit - mean_logit[:, np.newaxis])).sum(axis=1)
+        variance = (weights * (log_x - mean_x[:, np.newaxis]) ** 2).sum(axis=1)
+        n = covariance / variance
+        d0i = np.exp(mean_x - mean_logit / n)
+
+        # Without enough points on the slope, d0i is the point closest to the half growth
+        fallback = ~(np.isfinite(n) & np.isfinite(d0i) & (n > 0) & (count >= 2))
+        closest = np.nanargmin(np.abs(np.where(np.isfinite(fraction), fraction, np.inf) - 0.5), axis=1)
+        d0i = np.where(fallback, xs[np.arange(len(xs)), closest], d0i)
+        n = np.where(fallback, 1.0, n)
+
+    return np.stack([np.clip(d0i, lower[:, 0], upper[:, 0]), np.clip(n, lower[:, 1], upper[:, 1]), s, o], axis=1)
+
+
+def hill_4p_residuals_and_jacobian(x, y, p):
+    """Residuals (N, m) and Jacobian (N, m, 4) of the Hill 4p function for N curves of m points"""
+    d0i, n, s, o = (p[:, i, np.newaxis] for i in range(4))
+    log_ratio = np.log(x / d0i)
+    u = np.exp(n * log_ratio)  # (x/d0i)**n
+    g = 1 / (1 + u)
+    residuals = o + s * g - y
+
+    jacobian = np.empty(x.shape + (4,))
+    jacobian[..., 0] = s * g ** 2 * u * n / d0i
+    jacobian[..., 1] = -s * g ** 2 * u * log_ratio
+    jacobian[..., 2] = g
+    jacobian[..., 3] = 1
+    return residuals, jacobian
+
+
+def fit_hill_4p_batch(x, y, p0: Optional[np.ndarray] = None, max_iterations: int = 200, ftol: float = 1e-10,
+                      xtol: float = 1e-10, gtol: float = 1e-10, covariance: bool = True
+                      ) -> Tuple[np.ndarray, Optional[np.ndarray], np.ndarray, np.ndarray]:
+    """Fit the Hill 4p function to N curves at once
+
+    `x` and `y` are arrays of shape (N, m). This is a Levenberg-Marquardt iteration run on all the curves
+    together, parameters stuck on one of their bounds are frozen for the step. When `p0` is not given, the
+    fit starts from the middle of the bounds, like `curve_fit` does.
+
+    Returns (popt, pcov, converged, nfev) with shapes (N, 4), (N, 4, 4), (N,) and (N,), the rows that did not
+    converge should be fitted again with `fitting.fit_hill_4p`. nfev is the number of evaluations of the
+    function for each curve. pcov is None without `covariance`.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    nb, points = x.shape
+    lower, upper = hill_4p_bounds(x)
+    if p0 is None:
+        p = (lower + upper) / 2
+    else:
+        p = np.clip(np.array(p0, dtype=float), lower, upper)
+
+    valid = np.isfinite(x).all(axis=1) & np.isfinite(y).all(axis=1) & (x > 0).all(axis=1)
+    x = np.where(valid[:, np.newaxis], x, 1.0)
+    y = np.where(valid[:, np.newaxis], y, 0.0)
+
+    with np.errstate(all="ignore"):
+        residuals, jacobian = hill_4p_residuals_and_jacobian(x, y, p)
+        cost = 0.5 * (residuals ** 2).sum(axis=1)
+        damping = np.full(nb, 1e-3)
+        converged = ~valid
+        nfev = np.ones(nb, dtype=int)
+        identity = np.eye(4)
+
+        for _ in range(max_iterations):
+            active = ~converged
+            if not active.any():
+                break
+            idx = np.flatnonzero(active)
+            r, jac, pa = residuals[idx], jacobian[idx], p[idx]
+            gradient = np.einsum("nmk,nm->nk", jac, r)
+            jtj = np.einsum("nmk,nml->nkl", jac, jac)
+
+            # Parameters on a bound that the gradient pushes outside are kept fixed for this step
+            frozen = ((pa <= lower[idx]) & (gradient > 0)) | ((pa >= upper[idx]) & (gradient < 0))
+            free = ~frozen
+            small_gradient = np.abs(gradient * free).max(axis=1) <= gtol
+
+            diagonal = np.maximum(np.diagonal(jtj, axis1=1, axis2=2), 1e-12)
+            system = jtj + (damping[idx, np.newaxis] * diagonal)[:, :, np.newaxis] * identity
+            mask = free[:, :, np.newaxis] & free[:, np.newaxis, :]
+            system = np.where(mask, system, identity)
+            rhs = np.where(free, -gradient, 0.0)
+            step = np.linalg.solve(system, rhs[..., np.newaxis])[..., 0]
+
+            candidate = np.clip(pa + step, lower[idx], upper[idx])
+            new_residuals, new_jacobian = hill_4p_residuals_and_jacobian(x[idx], y[idx], candidate)
+            new_cost = 0.5 * (new_residuals ** 2).sum(axis=1)
+            nfev[idx] += 1
+            improved = np.isfinite(new_cost) & (new_cost <= cost[idx])
+
+            taken = candidate - pa
+            small_step = np.abs(taken).max(axis=1) <= xtol * (xtol + np.abs(pa).max(axis=1))
+            small_reduction = improved & (cost[idx] - new_cost <= ftol * cost[idx])
+
+            accepted = idx[improved]
+            p[accepted] = candidate[improved]
+            residuals[accepted] = new_residuals[improved]
+            jacobian[accepted] = new_jacobian[improved]
+            cost[accepted] = new_cost[improved]
+            damping[idx] = np.where(improved, damping[idx] / 10, damping[idx] * 10)
+
+            converged[idx] = small_gradient | small_step | small_reduction
+
+        pcov = None
+        if covariance:
+            # Same covariance estimate as curve_fit, from the pseudo-inverse of the jacobian
+            pseudo_inverse = np.linalg.pinv(jacobian)
+            pcov = pseudo_inverse @ np.swapaxes(pseudo_inverse, 1, 2)
+            if points > 4:
+                pcov *= (2 * cost / (points - 4))[:, np.newaxis, np.newaxis]
+            else:
+                pcov[:] = np.inf
+
+    converged &= valid & np.isfinite(cost)
+    return p, pcov, converged, nfev
+
+
+def bootstrap_hill_4p_batch(x, y, popt, samples: int = 200, seeds: Optional[List] = None) -> np.ndarray:
+    """Residual bootstrap of the Hill 4p fits `popt` (N, 4) of the curves `x` and `y` (N, m)
+
+    Each sample is the fitted curve plus residuals drawn with replacement, all the samples of all the curves
+    are fitted together, starting from `popt`. `seeds` has a seed for the random draws of each curve.
+
+    Returns the parameters (N, samples, 4) of the samples, rows that did not converge are NaN."""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    popt = np.asarray(popt, dtype=float)
+    nb, points = x.shape
+    if seeds is None:
+        seeds = list(range(nb))
+    d0i, n, s, o = (popt[:, i, np.newaxis] for i in range(4))
+    with np.errstate(all="ignore"):
+        fitted = o + s / (1 + (x / d0i) ** n)
+    residuals = y - fitted
+    draws = np.stack([np.random.default_rng(seed).integers(0, points, (samples, points)) for seed in seeds])
+    y_samples = fitted[:, np.newaxis, :] + residuals[np.arange(nb)[:, np.newaxis, np.newaxis], draws]
+    x_samples = np.broadcast_to(x[:, np.newaxis, :], y_samples.shape)
+
+    p, _, converged, _ = fit_hill_4p_batch(x_samples.reshape(-1, points), y_samples.reshape(-1, points),
+                                           p0=np.repeat(popt, samples, axis=0), covariance=False)
+    p[~converged] = np.nan
+    return p.reshape(nb, samples, 4)
+
+
+def average_replicates(x, y) -> Tuple[np.ndarray, np.ndarray]:
+    """Sorted unique concentrations of each row of `x` (N, m) and the mean of `y` at each of them.
+    Rows with fewer unique concentrations are padded with NaN at the end"""
+    x = np.atleast_2d(np.asarray(x, dtype=float))
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    order = np.argsort(x, axis=1)
+    xs = np.take_along_axis(x, order, axis=1)
+    ys = np.take_along_axis(y, order, axis=1)
+    # Index of the unique concentration of each point in its row
+    group = np.concatenate([np.zeros((len(xs), 1), dtype=int), np.cumsum(xs[:, 1:] != xs[:, :-1], axis=1)], axis=1)
+    rows = np.broadcast_to(np.arange(len(xs))[:, np.newaxis], xs.shape)
+    count = np.zeros(xs.shape)
+    x_sum = np.zeros(xs.shape)
+    y_sum = np.zeros(xs.shape)
+    np.add.at(count, (rows, group), 1)
+    np.add.at(x_sum, (rows, group), xs)
+    np.add.at(y_sum, (rows, group), ys)
+    with np.errstate(invalid="ignore"):
+        return np.where(count > 0, x_sum / count, np.nan), np.where(count > 0, y_sum / count, np.nan)
+
+
+def pchip_slopes(x, y) -> np.ndarray:
+    """Slopes at the points of the monotone piecewise cubic (Fritsch-Carlson) interpolation of each row of `x`
+    and `y` (N, m), sorted and possibly padded with NaN at the end as given by `average_replicates`"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        h = np.diff(x, axis=1)
+        delta = np.diff(y, axis=1) / h
+        slopes = np.full(x.shape, np.nan)
+        w1 = 2 * h[:, 1:] + h[:, :-1]
+        w2 = h[:, 1:] + 2 * h[:, :-1]
+        same_direction = delta[:, :-1] * delta[:, 1:] > 0
+        slopes[:, 1:-1] = np.where(same_direction, (w1 + w2) / (w1 / delta[:, :-1] + w2 / delta[:, 1:]), 0.0)
+    # The end points take the slope of their segment
+    rows = np.arange(len(x))
+    last = np.isfinite(x).sum(axis=1) - 1
+    slopes[:, 0] = delta[:, 0] if delta.shape[1] > 0 else np.nan
+    has_segment = last > 0
+    slopes[rows[has_segment], last[has_segment]] = delta[rows[has_segment], last[has_segment] - 1]
+    return slopes
+
+
+def interpolated_crossing_batch(x, y, level: float, iterations: int = 60) -> np.ndarray:
+    """Lowest concentration where the monotone piecewise cubic interpolation of each curve `x`, `y` (N, m) is
+    equal to `level`, NaN for the curves that never reach it. Replicates at the same concentration are averaged.
+
+    The interpolation is monotone on each segment, so the crossing found in a segment is its only one. It is
+    found by bisection on all the curves at once, `iterations` halvings reach the precision of a float."""
+    xu, yu = average_replicates(x, y)
+    slopes = pchip_slopes(xu, yu)
+    difference = yu - level
+    start, end = difference[:, :-1], difference[:, 1:]
+    with np.errstate(invalid="ignore"):
+        crosses = (start * end <= 0) & ~((start == 0) & (end == 0)) & np.isfinite(start) & np.isfinite(end)
+    found = crosses.any(axis=1)
+    rows = np.arange(len(xu))[found]
+    segment = crosses[found].argmax(axis=1)
+
+    x0, x1 = xu[rows, segment], xu[rows, segment + 1]
+    y0, y1 = yu[rows, segment], yu[rows, segment + 1]
+    h = x1 - x0
+    m0, m1 = slopes[rows, segment] * h, slopes[rows, segment + 1] * h
+
+    def hermite(t):
+        t2 = t * t
+        t3 = t2 * t
+        return ((2 * t3 - 3 * t2 + 1) * y0 + (t3 - 2 * t2 + t) * m0 + (-2 * t3 + 3 * t2) * y1 + (t3 - t2) * m1
+                - level)
+
+    low = np.zeros(len(rows))
+    high = np.ones(len(rows))
+    low_sign = np.sign(hermite(low))
+    for _ in range(iterations):
+        middle = (low + high) / 2
+        below = np.sign(hermite(middle)) == low_sign
+        low = np.where(below, middle, low)
+        high = np.where(below, high, middle)
+    crossing = np.full(len(xu), np.nan)
+    crossing[rows] = np.where(y0 == level, x0, x0 + h * (low + high) / 2)
+    return crossing
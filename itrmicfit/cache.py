@@ -0,0 +1,91 @@
+import hashlib
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+import numpy as np
+from pandas import DataFrame
+
+
+def curve_key(curve_df: DataFrame, *parameters: Any) -> str:
+    """Key identifying a curve by its content, `parameters` are things the fit depends on
+    (MIC percentage, dilution factor, fitting options…)"""
+    digest = hashlib.sha256()
+    for column in ("x", "measured"):
+        digest.update(np.ascontiguousarray(curve_df[column].values, dtype=np.float64).tobytes())
+    digest.update(repr(parameters).encode())
+    return digest.hexdigest()
+
+
+class FitCache:
+    """Least recently used cache of fits keyed by `curve_key`
+
+    At most `maxsize` fits are kept in memory. If `path` is given, the fits are also stored in a SQLite
+    database at that path, so they survive restarts, it keeps at most `disk_maxsize` of them."""
+
+    def __init__(self, maxsize: int = 4096, path: Optional[str] = None, disk_maxsize: int = 100000):
+        self.maxsize = maxsize
+        self.disk_maxsize = disk_maxsize
+        self._memory: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS fits (key TEXT PRIMARY KEY, fit BLOB, accessed REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS fits_accessed ON fits (accessed)")
+            self._db.commit()
+
+    def __len__(self):
+        return len(self._memory)
+
+    def __contains__(self, key: str):
+        return self.get(key) is not None
+
+    def get(self, key: str):
+        """The fit stored for `key` or None"""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+            if self._db is None:
+                return None
+            row = self._db.execute("SELECT fit FROM fits WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE fits SET accessed = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            fit = pickle.loads(row[0])
+            self._remember(key, fit)
+            return fit
+
+    def set(self, key: str, fit):
+        with self._lock:
+            self._remember(key, fit)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO fits VALUES (?, ?, ?)",
+                                 (key, pickle.dumps(fit, protocol=pickle.HIGHEST_PROTOCOL), time.time()))
+                self._db.execute("DELETE FROM fits WHERE key IN "
+                                 "(SELECT key FROM fits ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                                 (self.disk_maxsize,))
+                self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM fits")
+                self._db.commit()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _remember(self, key: str, fit):
+        self._memory[key] = fit
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
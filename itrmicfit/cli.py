@@ -0,0 +1,181 @@
+"""Headless batch processing of plate files
+
+    python -m itrmicfit data/ other/*.xlsx --output results --workers 4
+"""
+import argparse
+import glob
+import logging
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from .engine import Engine
+from .fitting import PLOT_POINTS
+
+
+@dataclass
+class FileResult:
+    """Outcome of the processing of one file"""
+    path: str
+    seconds: float
+    results: Optional[pd.DataFrame] = None
+    export: Optional[str] = None
+    error: Optional[str] = None
+
+
+def find_files(paths: List[str]) -> List[str]:
+    """Files matching the given files, directories (their .xlsx files) or glob patterns, without duplicates"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            matches = sorted(glob.glob(os.path.join(path, "*.xlsx")))
+        else:
+            matches = sorted(glob.glob(path)) or [path]
+        files += [match for match in matches if not os.path.basename(match).startswith("~$")]
+    return list(dict.fromkeys(files))
+
+
+def export_paths(files: List[str], output: str) -> Dict[str, str]:
+    """Spreadsheet of the results of each file in `output`, named after the file. Files with the same name in
+    different directories are named after their path from the directory they have in common instead, and numbered
+    if that is still not enough."""
+    names = [os.path.splitext(os.path.basename(path))[0] for path in files]
+    if len(set(names)) < len(names):
+        root = os.path.commonpath([os.path.abspath(os.path.dirname(path)) for path in files])
+        names = [name if names.count(name) == 1
+                 else os.path.splitext(os.path.relpath(os.path.abspath(path), root))[0].replace(os.sep, "_")
+                 for path, name in zip(files, names)]
+    exports = {}
+    used = set()
+    for path, name in zip(files, names):
+        unique, index = name, 1
+        while unique in used:
+            index += 1
+            unique = f"{name}_{index}"
+        used.add(unique)
+        exports[path] = os.path.join(output, unique + "_results.xlsx")
+    return exports
+
+
+def process_file(path: str, export: str, mic: int = 90, thresholds: Optional[List[int]] = None,
+                 dilution_factor: float = 2.0, graphics: bool = False, batch: bool = False,
+                 closed_form: bool = False, bootstrap: int = 0, initial_guess: bool = False,
+                 piecewise_fallback: bool = False) -> FileResult:
+    """Load, fit and export a single file to the spreadsheet `export`, errors are reported in the result instead of
+    being raised"""
+    start = time.perf_counter()
+    try:
+        engine = Engine()
+        engine.batch = batch
+        engine.closed_form = closed_form
+        engine.bootstrap = bootstrap
+        engine.initial_guess = initial_guess
+        engine.piecewise_fallback = piecewise_fallback
+        engine.plot_points = PLOT_POINTS if graphics else 0
+        engine.thresholds = list(thresholds or [])
+        engine.load_file(path)
+        engine.data.dilution_factor = dilution_factor
+        engine.MICn = mic
+        engine.fit()
+
+        engine.export_as_spreadsheet(export, graphics=graphics, fits=engine.fits)
+        results = engine.export_as_dataframe()
+        results.insert(0, "file", path)
+        return FileResult(path, time.perf_counter() - start, results=results, export=export)
+    except Exception as error:
+        message = "".join(traceback.format_exception_only(type(error), error)).strip()
+        return FileResult(path, time.perf_counter() - start, error=message)
+
+
+def process_file_alone(path: str, export: str, **options) -> FileResult:
+    """process_file in a process of its own, a crash of that process only fails this file"""
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        try:
+            return executor.submit(process_file, path, export, **options).result()
+        except BrokenProcessPool as error:
+            return FileResult(path, time.perf_counter() - start, error=f"the process fitting the file died: {error}")
+
+
+def report(result: FileResult):
+    if result.error is None:
+        print(f"{result.path}: {len(result.results)} substances in {result.seconds:.2f}s -> {result.export}")
+    else:
+        print(f"{result.path}: failed in {result.seconds:.2f}s: {result.error}", file=sys.stderr)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m itrmicfit", description="Fit the MICs of plate files in batch")
+    parser.add_argument("paths", nargs="+", help="xlsx files, directories or glob patterns")
+    parser.add_argument("-o", "--output", default="results", help="directory where the results are written")
+    parser.add_argument("--mic", type=int, default=90, help="MIC percentage to fit")
+    parser.add_argument("--thresholds", type=int, nargs="*", default=[],
+                        help="other MIC percentages to export along the main one")
+    parser.add_argument("--dilution-factor", type=float, default=2.0)
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of files processed at the same time (default: one per CPU)")
+    parser.add_argument("--graphics", action="store_true", help="export the graphics in the spreadsheets")
+    parser.add_argument("--batch", action="store_true", help="fit all the curves of a file together")
+    parser.add_argument("--closed-form", action="store_true", help="calculate the MICs by inverting the fits")
+    parser.add_argument("--bootstrap", type=int, default=0,
+                        help="number of bootstrap samples for the confidence intervals (default: none)")
+    parser.add_argument("--initial-guess", action="store_true",
+                        help="start the fits from parameters estimated from each curve")
+    parser.add_argument("--piecewise-fallback", action="store_true",
+                        help="find the MICs the fits can't give on a piecewise interpolation of all the curves at once")
+    parser.add_argument("--table", default="results.csv",
+                        help="name of the consolidated results table in the output directory (.csv or .xlsx)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log the outputs of the solvers")
+    args = parser.parse_args(argv)
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG, format="%(processName)s %(name)s %(levelname)s: %(message)s")
+
+    files = find_files(args.paths)
+    if len(files) == 0:
+        parser.error("no file to process")
+    os.makedirs(args.output, exist_ok=True)
+
+    start = time.perf_counter()
+    results = {}
+    options = dict(mic=args.mic, thresholds=args.thresholds, dilution_factor=args.dilution_factor,
+                   graphics=args.graphics, batch=args.batch, closed_form=args.closed_form, bootstrap=args.bootstrap,
+                   initial_guess=args.initial_guess, piecewise_fallback=args.piecewise_fallback)
+    exports = export_paths(files, args.output)
+    # A process that dies (out of memory, crash in a native library) breaks the whole pool, the files that were
+    # not done are processed again one at a time to find which one it was
+    broken = []
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(process_file, path, exports[path], **options): path for path in files}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                broken.append(futures[future])
+                continue
+            report(result)
+            results[result.path] = result
+    for path in [path for path in files if path in broken]:
+        result = process_file_alone(path, exports[path], **options)
+        report(result)
+        results[path] = result
+
+    tables = [results[path].results for path in files if results[path].error is None]
+    failed = [path for path in files if results[path].error is not None]
+    table = os.path.join(args.output, args.table)
+    if len(tables) > 0:
+        consolidated = pd.concat(tables, ignore_index=True)
+        if table.endswith(".xlsx"):
+            consolidated.to_excel(table, index=False)
+        else:
+            consolidated.to_csv(table, index=False)
+
+    print(f"{len(files) - len(failed)}/{len(files)} files processed in {time.perf_counter() - start:.2f}s"
+          + (f", results in {table}" if len(tables) > 0 else ""))
+    return 1 if len(failed) > 0 else 0
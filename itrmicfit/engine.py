@@ -1,17 +1,23 @@
-from .plotting import plot
+from .cache import FitCache
+from .profiling import Report, compound_profile
 from .sourcedata import SourceData
-from .fitting import fit_from_sourcedata, Fit
-from openpyxl.utils.dataframe import dataframe_to_rows
+from .sweep import sweep
+from .fitting import (fit_curves_from_sourcedata, evaluate_curves, evaluate_thresholds, iter_curves_and_fits,
+                      iterate_async, Curve, Fit, FitType, PLOT_POINTS)
 
+import csv
 import io
 
-import openpyxl
-import openpyxl.drawing.image
+import numpy as np
 import pandas as pd
-from PIL import Image
-from typing import List
+from numpy import nan
+from math import ceil
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Set, Tuple
 
-import matplotlib.pyplot as plt
+
+DEFAULT_ROW_HEIGHT = 20  # height of a spreadsheet row, in pixels
+MAX_PREALLOCATED_ROWS = 65536  # rows allocated ahead when reading a sheet, its dimension may be stale
+INTERVAL_COLUMNS = ["mic", "hill4p_d0i", "hill4p_n", "hill4p_s", "hill4p_o"]  # exported confidence intervals
 
 
 class LoadError(Exception):
@@ -19,10 +25,64 @@ class LoadError(Exception):
     pass
 
 
+def _to_float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return nan
+
+
+def read_worksheet(worksheet, min_row: int, min_col: int) -> SourceData:
+    """Read the 14 columns of plate data starting at (`min_row`, `min_col`) of a worksheet, row by row,
+    into preallocated arrays. Empty rows are skipped.
+
+    If the name and initial concentration columns are empty, names are "" and initial concentrations 1."""
+    # The dimension of the sheet, when known, gives the number of rows to expect
+    capacity = min(max((worksheet.max_row or 0) - min_row + 1, 16), MAX_PREALLOCATED_ROWS)
+    values = np.empty((capacity, 12))
+    names = np.empty(capacity, dtype=object)
+    initial_concentrations = np.empty(capacity)
+    has_names = False
+    length = 0
+    for row in worksheet.iter_rows(min_row=min_row, min_col=min_col, max_col=min_col + 13, values_only=True):
+        if all(value is None for value in row):
+            continue
+        if length == capacity:
+            capacity *= 2
+            values = np.resize(values, (capacity, 12))
+            names = np.resize(names, capacity)
+            initial_concentrations = np.resize(initial_concentrations, capacity)
+        row = tuple(row) + (None,) * (14 - len(row))
+        values[length] = [_to_float(value) for value in row[:12]]
+        names[length] = nan if row[12] is None else row[12]
+        initial_concentrations[length] = _to_float(row[13])
+        has_names |= row[12] is not None or row[13] is not None
+        length += 1
+
+    # Copies, so the data doesn't keep the preallocated arrays alive
+    if has_names:
+        return SourceData.from_arrays(values[:length].copy(), names[:length].copy(),
+                                      initial_concentrations[:length].copy())
+    return SourceData.from_arrays(values[:length].copy(), np.full(length, ""), np.ones(length))
+
+
 class Engine:
     data = None
     fits: List[Fit] = []
-    MICn: int = 90
+    curves: List[Curve] = []  # the fitted curves, they are kept to estimate the MICs again without fitting
+    _MICn: int = 90
+    workers: Optional[int] = None  # number of processes used to fit, None fits in this process, 0 uses all CPUs
+    chunksize: int = 1  # number of substances sent to a fitting process at a time
+    batch: bool = False  # fit the Hill 4p parameters of all the substances together
+    closed_form: bool = False  # calculate the MICs by inverting the fitted function instead of solving numerically
+    cache: Optional[FitCache] = None  # fits already done, substances with unchanged data are not fitted again
+    fits_per_page: int = 8  # number of fits on each image of the exported graphics
+    plot_points: int = PLOT_POINTS  # resolution of the fitted curves kept for plotting, 0 when nothing is plotted
+    diagnostics: bool = False  # keep the outputs of the solvers on each fit, see fitting.evaluate_curve
+    bootstrap: int = 0  # number of bootstrap samples for the confidence intervals, 0 for none
+    initial_guess: bool = False  # start the fits from parameters estimated from each curve
+    piecewise_fallback: bool = False  # interpolate all the curves the fit can't give a MIC for at once
+    warm_start: bool = False  # start the fits of substances fitted before from their previous parameters
     DEFAULT_COLUMNS = ["blank", '0', '1', '2', '3', '4', '5', '6', '7', '8',
                        "bacterial_control", "blank2", "name", "initial_concentration"]
 
@@ -32,45 +92,72 @@ class Engine:
 
     def __init__(self):
         self.data = None
+        self.report = Report()  # timings of the stages and of each substance, it can be given a sink
+        self.thresholds: List[int] = []  # other MIC percentages to estimate and export along MICn
+        self.threshold_fits: Dict[int, List[Fit]] = {}  # for each of the thresholds, fits in the same order as fits
+        self.changed_names: Set[str] = set()  # substances that got rows since they were fitted
+        self._fitted_with = None  # the options the curves were fitted with
+
+    @property
+    def MICn(self) -> int:
+        return self._MICn
+
+    @MICn.setter
+    def MICn(self, value: int):
+        """Changing the MIC percentage of fitted data estimates the MICs again, without fitting"""
+        changed = value != self._MICn
+        self._MICn = value
+        if changed and len(self.curves) > 0:
+            self.evaluate()
 
     def load_file(self, file):
-        self.clean_fits()
+        """Load a plate file, added to the data already loaded. The fits already done stay, the next `fit` only
+        fits the substances that are new or got more rows"""
+        import openpyxl
 
         # That's the way we detect "raw" files
+        # The workbook is opened read-only, so the sheet is streamed instead of being loaded at once
+        with self.report.stage("parse"):
+            workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+            try:
+                if "End point" in workbook.sheetnames:
+                    source = read_worksheet(workbook["End point"], min_row=16, min_col=2)
+                elif "RAW" in workbook.sheetnames:
+                    source = read_worksheet(workbook["RAW"], min_row=1, min_col=1)
+                else:
+                    raise LoadError(
+                        """The loaded file does not contain a file in one of the supported formats.
+                        If you made a combined file, did you call the sheet "RAW"?
+                        """)
+            finally:
+                workbook.close()
 
-        file = openpyxl.open(file, data_only=True)
+        self.add_data(source)
 
-        worksheets_names = [name.title for name in file.worksheets]
+        if self.onLoadDone is not None:
+            self.onLoadDone()
 
-        if "End point" in worksheets_names:
-            source_df = pd.read_excel(file, usecols="B:O", skiprows=15, header=None, engine="openpyxl",
-                                      sheet_name="End point").dropna(axis=0, how="all")
+    def save_data(self, file):
+        """Save the loaded data in a .npz file that `load_data` reads, see `SourceData.save`"""
+        self.data.save(file)
 
-        elif "RAW" in worksheets_names:
-            source_df = pd.read_excel(file, usecols="A:N", skiprows=0, header=None, engine="openpyxl",
-                                      sheet_name="RAW").dropna(axis=0, how="all")
-        else:
-            raise LoadError(
-                """The loaded file does not contain a file in one of the supported formats.
-                If you made a combined file, did you call the sheet "RAW"?
-                """)
-        default_columns = self.DEFAULT_COLUMNS
-
-        # Do we have a file with no name and initial concentrations?
-        if len(source_df.columns) == len(default_columns) - 2:
-            source_df["name"] = [""] * len(source_df)
-            source_df["initial_concentration"] = [1] * len(source_df)
-        source_df.columns = default_columns
-
-        if self.data is not None:
-            new_data = pd.concat([self.data.data, source_df]).reset_index(drop=True)
-            self.data = SourceData(new_data)
-        else:
-            self.data = SourceData(source_df.reset_index(drop=True))
+    def load_data(self, file):
+        """Load data saved with `save_data`, added to the current data like `load_file` does"""
+        with self.report.stage("parse"):
+            source = SourceData.load(file)
+        self.add_data(source)
 
         if self.onLoadDone is not None:
             self.onLoadDone()
 
+    def add_data(self, source: SourceData):
+        """Add the rows of `source` to the data, the substances in it will be fitted again"""
+        if self.data is None:
+            self.data = source
+        else:
+            self.data.append(source)
+        self.changed_names.update(source.name_categories)
+
     def clear(self):
         """Clear the current data"""
         self.clean_fits()
@@ -78,14 +165,142 @@ class Engine:
 
     def clean_fits(self):
         self.fits = []
+        self.curves = []
+        self.threshold_fits = {}
+        self.changed_names = set()
+        self._fitted_with = None
+
+    def fit(self, workers: Optional[int] = None, chunksize: Optional[int] = None, batch: Optional[bool] = None,
+            closed_form: Optional[bool] = None):
+        """Fit all the substances, the arguments override the options of the engine for this call.
+
+        The curves of substances that did not get new rows since the last fit are kept, unless the dilution
+        factor or the fitting method changed. With `warm_start`, the substances fitted again start from the
+        parameters of their previous fit if the dilution factor didn't change."""
+        if workers is None:
+            workers = self.workers
+        if chunksize is None:
+            chunksize = self.chunksize
+        if batch is None:
+            batch = self.batch
+        with self.report.stage("normalize"):
+            self.data.calculate()
+        with self.report.stage("fit"):
+            options, fitted, warm_starts = self._refit_options(batch)
+            self.curves = fit_curves_from_sourcedata(self.data, workers=workers, chunksize=chunksize, batch=batch,
+                                                     cache=self.cache, fitted=fitted, bootstrap=self.bootstrap,
+                                                     initial_guess=self.initial_guess, warm_starts=warm_starts)
+            self._fitted_with = options
+            self.changed_names = set()
+        self.evaluate(workers=workers, chunksize=chunksize, closed_form=closed_form)
+
+    def _refit_options(self, batch: bool) -> Tuple[tuple, Dict[str, Curve], Optional[Dict]]:
+        """The options of a fit, the curves that can be kept from the last fit and the warm starts of the others"""
+        options = (self.data.dilution_factor, batch, self.bootstrap, self.initial_guess)
+        fitted = {}
+        if options == self._fitted_with:
+            fitted = {curve.name: curve for curve in self.curves if curve.name not in self.changed_names}
+        warm_starts = None
+        if self.warm_start and self._fitted_with is not None and self._fitted_with[0] == options[0]:
+            warm_starts = {curve.name: curve.fitted_curve[0] for curve in self.curves
+                           if curve.name not in fitted and curve.type_of_fit == FitType.FITTED}
+        return options, fitted, warm_starts
+
+    def iter_fit(self, ordered: bool = True) -> Iterator[Fit]:
+        """Like `fit`, but yields the fit (at MICn) of each substance as soon as it is done, in the order of the
+        substances with `ordered`, in the order they are done otherwise (with workers, the first ones come sooner).
+
+        `curves`, `fits` and `threshold_fits` are only replaced once the iterator is exhausted, stopping early
+        leaves those of the last fit. The "fit" stage of the report includes the solving, and the time spent by
+        the consumer."""
+        for _, fits in self._iter_fit(ordered):
+            yield fits[0]
+
+    def aiter_fit(self, ordered: bool = True) -> AsyncIterator[Fit]:
+        """`iter_fit` as an async iterator, the fitting is done in a thread"""
+        return iterate_async(self.iter_fit(ordered))
+
+    def _iter_fit(self, ordered: bool, keep: bool = True) -> Iterator[Tuple[int, List[Fit]]]:
+        """(index, fits) of each substance, its fit at MICn followed by those of the thresholds.
+        Without `keep`, the curves and fits are not kept, they can be dropped as soon as they are consumed,
+        and the engine is left without fits once the iterator is exhausted."""
+        with self.report.stage("normalize"):
+            self.data.calculate()
+        options, fitted, warm_starts = self._refit_options(self.batch)
+        count = len(self.data.name_categories)
+        curves: List[Optional[Curve]] = [None] * count if keep else []
+        fits_by_n: List[List[Optional[Fit]]] = [[None] * count if keep else []
+                                                for _ in range(1 + len(self.thresholds))]
+        profiles = [None] * count
+        ns = [self.MICn / 100.0] + [percentage / 100.0 for percentage in self.thresholds]
+        with self.report.stage("fit"):
+            for index, curve, fits in iter_curves_and_fits(self.data, ns, workers=self.workers,
+                                                           chunksize=self.chunksize, batch=self.batch,
+                                                           closed_form=self.closed_form, cache=self.cache,
+                                                           plot_points=self.plot_points,
+                                                           diagnostics=self.diagnostics, bootstrap=self.bootstrap,
+                                                           initial_guess=self.initial_guess, fitted=fitted,
+                                                           warm_starts=warm_starts, ordered=ordered,
+                                                           piecewise=self.piecewise_fallback):
+                profiles[index] = compound_profile(curve, fits[0])
+                if keep:
+                    curves[index] = curve
+                    for fits_of_n, fit in zip(fits_by_n, fits):
+                        fits_of_n[index] = fit
+                yield index, fits
+            self.curves = curves
+            self.fits = fits_by_n[0]
+            self.threshold_fits = dict(zip(self.thresholds, fits_by_n[1:])) if keep else {}
+            self._fitted_with = options if keep else None
+            self.changed_names = set()
+        self.report.record_profiles(profiles)
+
+        if self.onFitDone is not None:
+            self.onFitDone()
+
+    def sweep(self, dilution_factors: List[float], percentages: List[int]) -> pd.DataFrame:
+        """MICs of the loaded data for each dilution factor and MIC percentage of the grid, with the options of the
+        engine, see sweep.sweep. The data is normalized once and the fits of the engine are left as they are."""
+        with self.report.stage("normalize"):
+            self.data.calculate()
+        with self.report.stage("fit"):
+            return sweep(self.data, dilution_factors, percentages, workers=self.workers, chunksize=self.chunksize,
+                         batch=self.batch, closed_form=self.closed_form, cache=self.cache, bootstrap=self.bootstrap,
+                         initial_guess=self.initial_guess, piecewise=self.piecewise_fallback)
 
-    def fit(self):
-        self.data.calculate()
-        self.fits = fit_from_sourcedata(self.data, self.MICn / 100.0)
+    def evaluate(self, workers: Optional[int] = None, chunksize: Optional[int] = None,
+                 closed_form: Optional[bool] = None):
+        """Estimate the MICs of the curves already fitted, this is what needs to be done again when MICn changes"""
+        if workers is None:
+            workers = self.workers
+        if chunksize is None:
+            chunksize = self.chunksize
+        if closed_form is None:
+            closed_form = self.closed_form
+        with self.report.stage("solve"):
+            self.fits = evaluate_curves(self.curves, self.MICn / 100.0, workers=workers, chunksize=chunksize,
+                                        closed_form=closed_form, cache=self.cache, plot_points=self.plot_points,
+                                        diagnostics=self.diagnostics, piecewise=self.piecewise_fallback)
+            fits = evaluate_thresholds(self.curves, [percentage / 100.0 for percentage in self.thresholds],
+                                       workers=workers, chunksize=chunksize, closed_form=closed_form,
+                                       cache=self.cache, plot_points=self.plot_points, diagnostics=self.diagnostics,
+                                       piecewise=self.piecewise_fallback)
+            self.threshold_fits = {percentage: fits[percentage / 100.0] for percentage in self.thresholds}
+        self.report.record_compounds(self.curves, self.fits)
 
         if self.onFitDone is not None:
             self.onFitDone()
 
+    def evaluate_thresholds(self, percentages: List[int]) -> Dict[int, List[Fit]]:
+        """Estimate the MICs for each of the percentages from the same fits, fitting first if needed.
+        They are exported along the MICn ones"""
+        self.thresholds = list(percentages)
+        if len(self.curves) == 0:
+            self.fit()
+        else:
+            self.evaluate()
+        return self.threshold_fits
+
     def pretty_print_mic(self, value):
         if type(value) is str:
             return value
@@ -98,63 +313,186 @@ class Engine:
         else:
             return [None, None, None, None]
 
+    def get_intervals(self, fit: Fit) -> List[Optional[float]]:
+        """Low and high bounds of the bootstrap confidence intervals of the MIC, d0i, n, s and o of a fit"""
+        intervals = fit.uncertainties.get("ci") or {}
+        bounds = []
+        for name in ("mic", "d0i", "n", "s", "o"):
+            bounds += intervals.get(name) or [None, None]
+        return list(bounds)
+
+    def has_intervals(self) -> bool:
+        return any(fit.uncertainties.get("ci") is not None for fit in self.fits)
+
     def export_as_dataframe(self):
         data = []
+        intervals = self.has_intervals()
 
         for index, fit in enumerate(self.fits):
-            data.append({"name": fit.name,
-                         "initial concentration": self.data.initial_concentrations[index],
-                         "type of fit": fit.type_of_fit.value,
-                         "mic percentage": int(fit.mic.percentage * 100),
-                         "mic concentration": self.pretty_print_mic(fit.mic.concentration),
-                         "mic quality": fit.mic.quality.value,
-                         "mic uncertainty": str(fit.uncertainties["mic"]),
-                         "hill4p_d0i": self.get_fit(fit.fitted_curve)[0],
-                         "hill4p_n": self.get_fit(fit.fitted_curve)[1],
-                         "hill4p_s": self.get_fit(fit.fitted_curve)[2],
-                         "hill4p_o": self.get_fit(fit.fitted_curve)[3]
-                         })
+            d0i, n, s, o = self.get_fit(fit.fitted_curve)
+            row = {"name": fit.name,
+                   "initial concentration": self.data.initial_concentrations[index],
+                   "type of fit": fit.type_of_fit.value,
+                   "mic percentage": int(fit.mic.percentage * 100),
+                   "mic concentration": self.pretty_print_mic(fit.mic.concentration),
+                   "mic quality": fit.mic.quality.value,
+                   "mic uncertainty": str(fit.uncertainties["mic"]),
+                   "hill4p_d0i": d0i,
+                   "hill4p_n": n,
+                   "hill4p_s": s,
+                   "hill4p_o": o
+                   }
+            if intervals:
+                bounds = iter(self.get_intervals(fit))
+                for column in INTERVAL_COLUMNS:
+                    row[f"{column} ci low"] = next(bounds)
+                    row[f"{column} ci high"] = next(bounds)
+            for percentage, fits in self.threshold_fits.items():
+                row[f"mic{percentage} concentration"] = self.pretty_print_mic(fits[index].mic.concentration)
+                row[f"mic{percentage} quality"] = fits[index].mic.quality.value
+                row[f"mic{percentage} uncertainty"] = str(fits[index].uncertainties["mic"])
+                if intervals:
+                    row[f"mic{percentage} ci low"], row[f"mic{percentage} ci high"] = \
+                        self.get_intervals(fits[index])[:2]
+            data.append(row)
         return pd.DataFrame(data)
 
-    def export_as_spreadsheet(self, file, graphics=True, fits=None):
-        """Export as a spreadsheet both the data and the graphic, with large files,
-        we may want to not export the graphics."""
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.append(
-            ["name", "initial_concentration", "type_of_fit", "mic_percentage", "mic_concentration", "mic_quality",
-             "mic_uncertainty", "hill4p_d0i", "hill4p_n", "hill4p_s", "hill4p_o"])
+    def spreadsheet_header(self, intervals: Optional[bool] = None,
+                           percentages: Optional[List[int]] = None) -> List[str]:
+        """Columns of the spreadsheet export, with the confidence intervals if the fits have some (or if
+        `intervals`) and the MICs of the threshold fits (or of the `percentages`)"""
+        header = ["name", "initial_concentration", "type_of_fit", "mic_percentage", "mic_concentration", "mic_quality",
+                  "mic_uncertainty", "hill4p_d0i", "hill4p_n", "hill4p_s", "hill4p_o"]
+        if intervals is None:
+            intervals = self.has_intervals()
+        if intervals:
+            for column in INTERVAL_COLUMNS:
+                header += [f"{column}_ci_low", f"{column}_ci_high"]
+        for percentage in (self.threshold_fits if percentages is None else percentages):
+            header += [f"mic{percentage}_concentration", f"mic{percentage}_quality", f"mic{percentage}_uncertainty"]
+            if intervals:
+                header += [f"mic{percentage}_ci_low", f"mic{percentage}_ci_high"]
+        return header
+
+    def spreadsheet_rows(self):
+        """The rows of results of the spreadsheet export, one per fit"""
+        intervals = self.has_intervals()
         for index, fit in enumerate(self.fits):
-            ws.append([fit.name,
-                       self.data.initial_concentrations[index],
-                       fit.type_of_fit.value,
-                       int(fit.mic.percentage * 100),
-                       fit.mic.concentration,
-                       fit.mic.quality.value,
-                       str(fit.uncertainties["mic"]),
-                       self.get_fit(fit.fitted_curve)[0],
-                       self.get_fit(fit.fitted_curve)[1],
-                       self.get_fit(fit.fitted_curve)[2],
-                       self.get_fit(fit.fitted_curve)[3]
-                       ])
+            yield self.spreadsheet_row(index, fit, intervals)
 
-        ws_source = wb.create_sheet("RAW")
-        for r in dataframe_to_rows(self.data.data, index=False, header=False):
-            ws_source.append(r)
-
-        if graphics is True:
-            ws1 = wb.create_sheet("Graphic")
-            fig = plt.figure(1, (20, 20), tight_layout=True)
-            plot(fits, fig=fig)
-            buf = io.BytesIO()
-            fig.savefig(buf, format='png', dpi=100)
-            buf.seek(0)
-            im = Image.open(buf)
-            img = openpyxl.drawing.image.Image(im)
-            img.anchor = "A1"
-            ws1.add_image(img)
+    def spreadsheet_row(self, index: int, fit: Fit, intervals: bool,
+                        threshold_fits: Optional[Dict[int, Fit]] = None) -> list:
+        """The row of results of the `index`-th substance, with its `threshold_fits` by percentage, those in
+        `threshold_fits` of the engine by default"""
+        if threshold_fits is None:
+            threshold_fits = {percentage: fits[index] for percentage, fits in self.threshold_fits.items()}
+        row = [fit.name,
+               self.data.initial_concentrations[index],
+               fit.type_of_fit.value,
+               int(fit.mic.percentage * 100),
+               fit.mic.concentration,
+               fit.mic.quality.value,
+               str(fit.uncertainties["mic"]),
+               *self.get_fit(fit.fitted_curve)
+               ]
+        if intervals:
+            row += self.get_intervals(fit)
+        for threshold_fit in threshold_fits.values():
+            row += [threshold_fit.mic.concentration, threshold_fit.mic.quality.value,
+                    str(threshold_fit.uncertainties["mic"])]
+            if intervals:
+                row += self.get_intervals(threshold_fit)[:2]
+        return row
 
-        wb.save(file)
+    def fit_to_csv(self, file, ordered: bool = True, keep: bool = True):
+        """Fit like `iter_fit`, writing the row of results of each substance to the CSV `file` (a path or a text
+        file object) as soon as it is done, with the columns of the spreadsheet export.
+        Without `ordered`, the rows are in the order the substances were done. Without `keep`, the fits are not
+        kept on the engine, each one is dropped once its row is written."""
+        intervals = self.bootstrap > 0
+        if isinstance(file, str):
+            with open(file, "w", newline="") as opened:
+                return self.fit_to_csv(opened, ordered, keep)
+        writer = csv.writer(file)
+        writer.writerow(self.spreadsheet_header(intervals, self.thresholds))
+        for index, fits in self._iter_fit(ordered, keep):
+            writer.writerow(self.spreadsheet_row(index, fits[0], intervals, dict(zip(self.thresholds, fits[1:]))))
+            file.flush()
+
+    def fit_to_spreadsheet(self, file, graphics: bool = True, ordered: bool = True, keep: bool = True):
+        """Fit like `iter_fit`, appending the row of results of each substance to the spreadsheet export as soon as
+        it is done, and its page of graphics as soon as the page is full. Without `ordered`, the rows and the pages
+        are in the order the substances were done. Without `keep`, the fits are not kept on the engine, each one
+        is dropped once its row and its page are written. The "fit" stage of the report includes the export."""
+        stream = ((index, fits[0], self.spreadsheet_row(index, fits[0], self.bootstrap > 0,
+                                                        dict(zip(self.thresholds, fits[1:]))))
+                  for index, fits in self._iter_fit(ordered, keep))
+        self._export_as_spreadsheet(file, graphics, None, stream)
+
+        if self.onExportDone is not None:
+            self.onExportDone(file)
+
+    def export_as_spreadsheet(self, file, graphics=True, fits=None):
+        """Export as a spreadsheet both the data and the graphic, with large files,
+        we may want to not export the graphics.
+
+        `file` is a path or a binary file object (like io.BytesIO). The sheets are write-only,
+        so rows are streamed to the file instead of being kept in memory."""
+        with self.report.stage("export"):
+            self._export_as_spreadsheet(file, graphics, fits)
 
         if self.onExportDone is not None:
             self.onExportDone(file)
+
+    def _export_as_spreadsheet(self, file, graphics, fits, stream=None):
+        """Write the export, the results of `stream`, (index, fit, row) of each substance, are written as they
+        come, with a page of graphics each time enough fits came"""
+        # The spreadsheet and graphics libraries are only imported when exporting
+        import openpyxl
+        import openpyxl.drawing.image
+        from PIL import Image
+        from .rendering import render_pages
+
+        # Write-only sheets are each streamed to a file of their own, they can be filled in any order
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet("Sheet")
+        ws_source = wb.create_sheet("RAW")
+        ws1 = wb.create_sheet("Graphic") if graphics is True else None
+        row = 1
+
+        def add_pages(pages):
+            # One image per page of fits, one under the other
+            nonlocal row
+            for png in pages:
+                im = Image.open(io.BytesIO(png))
+                img = openpyxl.drawing.image.Image(im)
+                img.anchor = f"A{row}"
+                ws1.add_image(img)
+                row += ceil(im.height / DEFAULT_ROW_HEIGHT) + 1
+
+        for values, name, initial_concentration in zip(self.data.values.tolist(), self.data.names,
+                                                       self.data.initial_concentrations.tolist()):
+            ws_source.append(values + [name, initial_concentration])
+
+        if stream is None:
+            ws.append(self.spreadsheet_header())
+            for results in self.spreadsheet_rows():
+                ws.append(results)
+            if ws1 is not None:
+                with self.report.stage("plot"):
+                    add_pages(render_pages(fits if fits is not None else self.fits, per_page=self.fits_per_page,
+                                           workers=self.workers))
+        else:
+            ws.append(self.spreadsheet_header(self.bootstrap > 0, self.thresholds))
+            page = []
+            for _, fit, results in stream:
+                ws.append(results)
+                if ws1 is not None:
+                    page.append(fit)
+                    if len(page) == self.fits_per_page:
+                        add_pages(render_pages(page, per_page=self.fits_per_page))
+                        page = []
+            if len(page) > 0:
+                add_pages(render_pages(page, per_page=self.fits_per_page))
+
+        wb.save(file)
@@ -1,15 +1,30 @@
-from scipy import interpolate
+import asyncio
+import logging
+import os
 import numpy as np
-from pandas import DataFrame
-from scipy.optimize import curve_fit, fsolve
-from typing import List, Any
-from dataclasses import dataclass
+from pandas import DataFrame, factorize
+from typing import AsyncIterator, Container, Dict, Iterable, Iterator, List, Any, Optional, Tuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice, repeat
+from dataclasses import dataclass, field, replace
+from time import perf_counter
 from enum import Enum
-from uncertainties import ufloat
 
+from .batchfitting import (bootstrap_hill_4p_batch, fit_hill_4p_batch, hill_4p_bounds, hill_4p_initial_guess,
+                           interpolated_crossing_batch)
+from .cache import FitCache, curve_key
 from .sourcedata import SourceData
 
 
+# scipy and uncertainties are imported in the functions using them, they are slow to import and not always needed
+
+PLOT_POINTS = 200  # resolution of the curves kept to plot the fits
+BOOTSTRAP_CONFIDENCE = 0.95  # level of the bootstrap confidence intervals
+BOOTSTRAP_CHUNK = 32  # number of curves bootstrapped together, chunks are spread over the workers
+
+logger = logging.getLogger(__name__)
+
+
 def hill_4p_function(concentration, d0i: float = 0.001, n: float = 10, s: float = 1, o: float = 0):
     """Hill 4p same as Hill 3p but with offset"""
     return o + s / (1 + (concentration / d0i) ** n)
@@ -20,20 +35,42 @@ def curve_to_dataframe(curve):
     return DataFrame(curve, columns=["x", "measured"])
 
 
-def fit_hill_4p(curve_df):
-    """Take the curve generated earlier and get the (popt, pcov, and function) of a fit of the hill 4p function"""
-    return (*curve_fit(hill_4p_function, curve_df.x.values, curve_df.measured.values, maxfev=100000, method="trf",
-                       bounds=((curve_df.x.min(), 0.0001, 0.01, 0.01), (curve_df.x.max(), 6, 4, 1))), hill_4p_function)
+def fit_hill_4p(curve_df, stats: Optional[Dict[str, Any]] = None, p0: Optional[np.ndarray] = None):
+    """Take the curve generated earlier and get the (popt, pcov, and function) of a fit of the hill 4p function.
+    The number of function evaluations is stored as "nfev" in `stats` if it is given.
+
+    The fit starts from `p0` (kept inside the bounds) if it is given, from the middle of the bounds otherwise"""
+    from scipy.optimize import curve_fit
+
+    lower, upper = hill_4p_bounds(curve_df.x.values[np.newaxis])
+    bounds = (lower[0], upper[0])
+    if p0 is not None:
+        p0 = np.clip(p0, *bounds)
+    popt, pcov, infodict, _, _ = curve_fit(hill_4p_function, curve_df.x.values, curve_df.measured.values, p0=p0,
+                                           maxfev=100000, method="trf", full_output=True, bounds=bounds)
+    if stats is not None:
+        stats["nfev"] = int(infodict["nfev"])
+    return popt, pcov, hill_4p_function
 
 
 def interpolate_curve_df_and_fitted(curve_df, curve_fitted, points=1000):
+    from scipy import interpolate
+
     x = np.linspace(curve_df.x.values.min(), curve_df.x.values.max(), num=points, endpoint=True)
     f = interpolate.interp1d(curve_df.x, curve_df.measured)
     df = DataFrame({'x': x, 'measured': f(x), 'fitted': curve_fitted[2](x, *curve_fitted[0])})
     return df
 
 
+def fitted_plot_curve(curve_df, curve_fitted, points=PLOT_POINTS):
+    """Compact (x, fitted) arrays to draw the fitted function over the measured range"""
+    x = np.linspace(curve_df.x.values.min(), curve_df.x.values.max(), num=points, endpoint=True)
+    return x.astype(np.float32), curve_fitted[2](x, *curve_fitted[0]).astype(np.float32)
+
+
 def interpolate_cspline(curve_df):
+    from scipy import interpolate
+
     sorted_df = curve_df.sort_values(by=['x'])
 
     tck = interpolate.splrep(sorted_df.x, sorted_df.measured, s=0)
@@ -45,6 +82,8 @@ def interpolate_cspline(curve_df):
 
 
 def interpolate_naive(curve_df):
+    from scipy import interpolate
+
     sorted_df = curve_df.sort_values(by=['x'])
 
     tck = interpolate.UnivariateSpline(sorted_df.x, sorted_df.measured)
@@ -62,6 +101,38 @@ def mic_intersect_prep(curve_fitted, limit=0.1):
     return mic_intersect
 
 
+def hill_4p_inverse(y, d0i, n, s, o):
+    """Concentration at which the Hill 4p function is equal to `y`, NaN where it never reaches it.
+    Works on arrays of parameters as well"""
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        base = s / (y - o) - 1
+        return np.where((y > o) & (base > 0), d0i * np.abs(base) ** (1 / n), np.nan)
+
+
+def mic_closed_form(curves_fitted: List[Any], n: float) -> List[Optional[float]]:
+    """MICn of all the fitted curves at once by inverting the Hill 4p function,
+    None for the curves that are not fitted"""
+    mics: List[Optional[float]] = [None] * len(curves_fitted)
+    fitted = [index for index, curve_fitted in enumerate(curves_fitted) if curve_fitted is not None]
+    if len(fitted) > 0:
+        popt = np.array([curves_fitted[index][0] for index in fitted])
+        for index, mic in zip(fitted, hill_4p_inverse(1 - n, *popt.T)):
+            mics[index] = mic
+    return mics
+
+
+def mic_interpolated(curve_dfs: List[DataFrame], n: float) -> List[float]:
+    """MICn of all the curves at once on the monotone piecewise cubic interpolation of their points, NaN for the
+    curves that never cross it, see `interpolated_crossing_batch`. Curves of the same length are done together"""
+    mics = [np.nan] * len(curve_dfs)
+    for indices in group_by_length(curve_dfs):
+        x = np.array([curve_dfs[index].x.values for index in indices], dtype=float)
+        measured = np.array([curve_dfs[index].measured.values for index in indices], dtype=float)
+        for index, mic in zip(indices, interpolated_crossing_batch(x, measured, 1 - n)):
+            mics[index] = mic
+    return mics
+
+
 def mic_intersect_interpolated_prep(f, limit=0.1):
     def mic_intersect(x):
         return f(x) - (1 - limit)
@@ -101,113 +172,688 @@ class Fit:
     original_curve: DataFrame
     fitted_curve: Any = None
     uncertainties: Any = None
+    plot_curve: Any = None  # (x, fitted) arrays to draw the fitted function, see fitted_plot_curve
+    stats: Dict[str, Any] = field(default_factory=dict)  # how the MIC was found, see evaluate_curve
+    diagnostics: Optional[Dict[str, Any]] = None  # outputs of the solvers, only kept on request
+
 
+@dataclass
+class Curve:
+    """The curve of a substance and its Hill 4p fit, they do not depend on the MIC percentage"""
+    name: str
+    original_curve: DataFrame
+    type_of_fit: FitType = FitType.NOT_FITTED
+    fitted_curve: Any = None
+    key: Optional[str] = None  # identifies the curve in a FitCache
+    stats: Dict[str, Any] = field(default_factory=dict)  # how the fit went, see fit_curve
+    bootstrap: Optional[np.ndarray] = None  # (samples, 4) Hill 4p parameters of the bootstrap, see bootstrap_curves
 
-def group_by_name_and_widen(df):
-    s = df.groupby("name").cumcount()
 
-    df1 = df.set_index(['name', s]).unstack().sort_index(level=1, axis=1)
-    df1.columns = [f'{x}-{y}' for x, y in df1.columns]
-    df1 = df1.reset_index()
-    return df1.dropna(axis=1)
+def group_rows_by_name(names) -> Tuple[List[str], List[np.ndarray]]:
+    """The names in the order they first appear and the indices of the rows of each of them, in one pass"""
+    codes, uniques = factorize(np.asarray(names), sort=False)
+    order = np.argsort(codes, kind="stable")
+    boundaries = np.flatnonzero(np.diff(codes[order])) + 1
+    return list(uniques), np.split(order, boundaries)
 
 
-def fit_from_sourcedata(data: SourceData, n: float) -> List[Fit]:
-    """Fit the curves from `data`, and estimate MICn
-       where n is [0,1]
-    """
-    fits = []
+def group_by_length(curve_dfs: List[DataFrame], indices: Optional[Iterable[int]] = None) -> List[List[int]]:
+    """Indices of the curves (all of them, or those of `indices`) grouped by number of points, so the curves of a
+    group can be stacked in arrays. The groups are in the order their first curve appears"""
+    by_length: Dict[int, List[int]] = {}
+    for index in (range(len(curve_dfs)) if indices is None else indices):
+        by_length.setdefault(len(curve_dfs[index]), []).append(index)
+    return list(by_length.values())
 
-    # Need to decouple curve making and values calculation
-    all_concentrations = group_by_name_and_widen(data.concentrations)
-    all_values = group_by_name_and_widen(data.values_normalized)
-    for substance in set(data.concentrations.name):
-        percentage = n
-        concentration = None
-        quality = MICQuality.NOT_DETERMINED
-
-        # Using the approch from:
-        # https://stackoverflow.com/questions/56071160/combine-multiple-rows-in-pandas-dataframe-and-create-new-columns
-
-        concentrations = all_concentrations[all_concentrations.name == substance].drop("name", axis=1).iloc[0, :]
-        measured = all_values[all_values.name == substance].drop("name", axis=1).iloc[0, :]
-
-        name = substance
-        curve_df = DataFrame({'x': concentrations.values, 'measured': measured.values})
-        _d0i = None
-        _n = None
-        _s = None
-        _o = None
-        mic_error = None
-        try:
-            curve_fitted = fit_hill_4p(curve_df)
-            sigmas = np.sqrt(np.diag(curve_fitted[1]))
 
-            _d0i = ufloat(curve_fitted[0][0], sigmas[0])
-            _n = ufloat(curve_fitted[0][1], sigmas[1])
-            _s = ufloat(curve_fitted[0][2], sigmas[2])
-            _o = ufloat(curve_fitted[0][3], sigmas[3])
+def fit_curve(name: str, curve_df: DataFrame, curve_fitted=None, p0: Optional[np.ndarray] = None) -> Curve:
+    """Fit the Hill 4p function on a single curve, `curve_fitted` can be given if the curve was already fitted.
+    The fit starts from `p0` if it is given, see `fit_hill_4p`.
 
+    The stats of the curve are the "fit_seconds" it took and the "nfev" function evaluations of curve_fit"""
+    stats = {"fit_seconds": 0.0, "nfev": 0}
+    if curve_fitted is None:
+        start = perf_counter()
+        try:
+            curve_fitted = fit_hill_4p(curve_df, stats, p0)
+        except RuntimeError:
+            stats["fit_seconds"] = perf_counter() - start
+            return Curve(name, curve_df, stats=stats)
+        stats["fit_seconds"] = perf_counter() - start
+    return Curve(name, curve_df, FitType.FITTED, curve_fitted, stats=stats)
+
+
+def bootstrap_intervals(parameters: np.ndarray, n: float,
+                        confidence: float = BOOTSTRAP_CONFIDENCE) -> Dict[str, Optional[Tuple[float, float]]]:
+    """Percentile confidence intervals of d0i, n, s, o and of the MICn from bootstrap `parameters` (samples, 4).
+    Samples that never reach the MIC are left out, its interval is None if none does"""
+    percentiles = [50 * (1 - confidence), 50 * (1 + confidence)]
+    intervals: Dict[str, Optional[Tuple[float, float]]] = {}
+    for name, values in zip(("d0i", "n", "s", "o"), parameters.T):
+        low, high = np.percentile(values, percentiles)
+        intervals[name] = (float(low), float(high))
+    mics = hill_4p_inverse(1 - n, *parameters.T)
+    mics = mics[np.isfinite(mics)]
+    intervals["mic"] = tuple(float(value) for value in np.percentile(mics, percentiles)) if len(mics) > 0 else None
+    return intervals
+
+
+def evaluate_curve(curve: Curve, n: float, closed_form: bool = False, mic: Optional[float] = None,
+                   plot_points: int = PLOT_POINTS, diagnostics: bool = False,
+                   interpolated_mic: Optional[float] = None) -> Fit:
+    """Estimate the MICn of a curve from its Hill 4p fit
+
+    With `closed_form`, the MIC is obtained by inverting the fitted function (or is the given `mic`),
+    it is only searched numerically if the inversion is not defined.
+
+    When the fit doesn't give a usable MIC, it is estimated on an interpolation of the points: `interpolated_mic`
+    if it is given (see `mic_interpolated`), otherwise (or if it is NaN) by solving on a cubic spline.
+
+    The fitted function is sampled on `plot_points` points to be plotted, 0 skips it (when nothing is plotted).
+
+    The stats of the fit are the "solve_seconds" it took, the "spline_seconds" spent in the cubic spline fallback
+    and if that "fallback" was needed.
+
+    With `diagnostics`, the full outputs of the solvers are kept in the diagnostics of the fit: "fsolve" and
+    "spline fsolve" (the fsolve tuples) and the "uncertainty error" if the MIC uncertainty could not be propagated.
+    They are also logged at the DEBUG level.
+
+    Curves that were bootstrapped get confidence intervals in the "ci" of the uncertainties, see
+    `bootstrap_intervals`. There is none for the MIC when it doesn't come from the fit."""
+    from scipy.optimize import fsolve
+    from uncertainties import ufloat
+
+    start = perf_counter()
+    solver_outputs: Dict[str, Any] = {}
+    spline_seconds = 0.0
+    fallback = False
+    name = curve.name
+    curve_df = curve.original_curve
+    curve_fitted = curve.fitted_curve
+    percentage = n
+    concentration = None
+    quality = MICQuality.NOT_DETERMINED
+    _d0i = None
+    _n = None
+    _s = None
+    _o = None
+    mic_error = None
+    if curve.type_of_fit == FitType.FITTED:
+        sigmas = np.sqrt(np.diag(curve_fitted[1]))
+
+        _d0i = ufloat(curve_fitted[0][0], sigmas[0])
+        _n = ufloat(curve_fitted[0][1], sigmas[1])
+        _s = ufloat(curve_fitted[0][2], sigmas[2])
+        _o = ufloat(curve_fitted[0][3], sigmas[3])
+
+        if closed_form and mic is None:
+            mic = hill_4p_inverse(1 - n, *curve_fitted[0])
+        if closed_form and np.isfinite(mic):
+            mic = np.float64(mic)
+            solved = True
+            # The fitted function is decreasing, its minimum is on the highest concentration
+            fitted_min = curve_fitted[2](curve_df.x.max(), *curve_fitted[0])
+        else:
             curve_interpolated = interpolate_curve_df_and_fitted(curve_df, curve_fitted)
             initial_value = curve_interpolated.x[(np.abs(curve_interpolated.fitted - (1 - n))).argmin()]
-            solve = fsolve(mic_intersect_prep(curve_fitted, n), initial_value, factor=0.1, full_output=True, xtol=0.01)
+            solve = fsolve(mic_intersect_prep(curve_fitted, n), initial_value, factor=0.1, full_output=True,
+                           xtol=0.01)
+            if diagnostics:
+                solver_outputs["fsolve"] = solve
+            logger.debug("fsolve of %s for MIC%s: %s", name, n, solve)
             mic = solve[0][0]
-            try:
-                mic_error = _d0i * (_s / ((1 - n) - _o) - 1) ** (1 / _n)
-            except ValueError:
-                print(f"Value Error for mic: {mic} _d0i: {_d0i} _s: {_s} n: {n} _o: {_o} _n: {_n}")
-                mic_error = None
-            print(solve)
-            if solve[2] == 1 and curve_interpolated.fitted.min() < mic:
-                # If the MIC is above the measured X value
-                if mic > curve_interpolated.x.max():
-                    quality = MICQuality.OVER_MEASURED_RANGE
-                else:
-                    quality = MICQuality.OK
+            solved = solve[2] == 1
+            fitted_min = curve_interpolated.fitted.min()
+        try:
+            mic_error = _d0i * (_s / ((1 - n) - _o) - 1) ** (1 / _n)
+        except (ValueError, OverflowError) as error:
+            # This is common, the message is only built when someone will read it
+            if diagnostics:
+                solver_outputs["uncertainty error"] = (f"{type(error).__name__} for mic: {mic} _d0i: {_d0i} _s: {_s} "
+                                                       f"n: {n} _o: {_o} _n: {_n}")
+            logger.debug("%s: %s for mic: %s _d0i: %s _s: %s n: %s _o: %s _n: %s", name, type(error).__name__, mic,
+                         _d0i, _s, n, _o, _n)
+            mic_error = None
+        if solved and fitted_min < mic:
+            # If the MIC is above the measured X value
+            if mic > curve_df.x.max():
+                quality = MICQuality.OVER_MEASURED_RANGE
+            else:
+                quality = MICQuality.OK
+        else:
+            if mic > curve_df.x.max():
+                quality = MICQuality.OVER_MEASURED_RANGE
+            else:
+                quality = MICQuality.POOR
+        concentration = mic
+
+        if (quality != MICQuality.OK) & (quality != MICQuality.POOR):
+            # We do not have a correct fit, we revert to a simple cubic splines interpolation
+            spline_start = perf_counter()
+            fallback = True
+            if interpolated_mic is not None and np.isfinite(interpolated_mic):
+                csvalue = interpolated_mic
             else:
-                if mic > curve_df.x.max():
-                    quality = MICQuality.OVER_MEASURED_RANGE
-                else:
-                    quality = MICQuality.POOR
-            concentration = mic
-
-            if (quality != MICQuality.OK) & (quality != MICQuality.POOR):
-                # We do not have a correct fit, we revert to a simple cubic splines interpolation
                 cscurve = interpolate_cspline(curve_df)
                 initial_value = curve_df.x.min()
-                solve = fsolve(mic_intersect_interpolated_prep(cscurve, n), initial_value, factor=0.1, full_output=True,
-                               xtol=0.01)
-                print("Trying to solve")
-                print(f"solve is : {solve}")
+                solve = fsolve(mic_intersect_interpolated_prep(cscurve, n), initial_value, factor=0.1,
+                               full_output=True, xtol=0.01)
+                if diagnostics:
+                    solver_outputs["spline fsolve"] = solve
+                logger.debug("spline fsolve of %s for MIC%s: %s", name, n, solve)
                 csvalue = solve[0][0]
+            spline_seconds = perf_counter() - spline_start
 
-                #if np.abs(curve_df.measured.min() - (1 - n)) < 0.01:
-                quality = MICQuality.ESTIMATED_FROM_INTERPOLATION
-                concentration = csvalue
-                mic_error = None
-                curve_fitted = None
-            # If the searched is above the minimaly measured X value
-            if (1 - n) <= curve_df.measured.min():
-                quality = MICQuality.OVER_MEASURED_RANGE
-                curve_fitted = None
-            elif (1 - n) >= curve_df.measured.max():
-                quality = MICQuality.UNDER_MEASURED_RANGE
-                curve_fitted = None
+            #if np.abs(curve_df.measured.min() - (1 - n)) < 0.01:
+            quality = MICQuality.ESTIMATED_FROM_INTERPOLATION
+            concentration = csvalue
+            mic_error = None
+            curve_fitted = None
+        # If the searched is above the minimaly measured X value
+        if (1 - n) <= curve_df.measured.min():
+            quality = MICQuality.OVER_MEASURED_RANGE
+            curve_fitted = None
+        elif (1 - n) >= curve_df.measured.max():
+            quality = MICQuality.UNDER_MEASURED_RANGE
+            curve_fitted = None
 
-            fit_type = FitType.FITTED
-        except RuntimeError:
-            fit_type = FitType.NOT_FITTED
+    fit_type = curve.type_of_fit
+
+    intervals = None
+    if curve.type_of_fit == FitType.FITTED and curve.bootstrap is not None and len(curve.bootstrap) > 0:
+        intervals = bootstrap_intervals(curve.bootstrap, n)
+        if curve_fitted is None:
+            intervals["mic"] = None
+
+    if quality == MICQuality.OVER_MEASURED_RANGE:
+        concentration = f"> {max(curve_df.x)} ({100 * max(curve_df.measured) - 100:00.0f}%)"
+    elif quality == MICQuality.UNDER_MEASURED_RANGE:
+        concentration = f"< {min(curve_df.x)} ({100 - 100 * min(curve_df.measured):00.0f}%)"
+    # if mic_error is not None:
+    #    if mic_error.std_dev>mic_error.n*4:
+    #        quality = MICQuality.POOR
+    if curve_fitted is not None and plot_points > 0:
+        curve_plot = fitted_plot_curve(curve_df, curve_fitted, plot_points)
+    else:
+        curve_plot = None
+    stats = {"solve_seconds": perf_counter() - start, "spline_seconds": spline_seconds, "fallback": fallback}
+    return Fit(name, fit_type, MIC(concentration, percentage, quality), curve_df, curve_fitted,
+               uncertainties={'d0i': _d0i, 'n': _n, 's': _s, 'o': _o, 'mic': mic_error, 'ci': intervals},
+               plot_curve=curve_plot,
+               stats=stats, diagnostics=solver_outputs if diagnostics else None)
+
+
+def fallback_expected(curve: Curve, n: float, mic: Optional[float] = None) -> bool:
+    """If `evaluate_curve` is expected to estimate the MICn of `curve` on an interpolation: its fit doesn't reach
+    1 - n in the measured range (or the closed form `mic` is over it)"""
+    if curve.type_of_fit != FitType.FITTED:
+        return False
+    x_max = curve.original_curve.x.max()
+    if mic is not None and np.isfinite(mic):
+        return mic > x_max
+    return curve.fitted_curve[2](x_max, *curve.fitted_curve[0]) > 1 - n
+
+
+def evaluate_curves_piecewise(curves: List[Curve], n: float, closed_form: bool, mics: List[Optional[float]],
+                              plot_points: int = PLOT_POINTS, diagnostics: bool = False,
+                              workers: Optional[int] = None, chunksize: int = 1) -> List[Fit]:
+    """`evaluate_curve` of each curve with the MICs it can't get from its fit found by `mic_interpolated`.
+    Only the curves expected to need it (see `fallback_expected`) are interpolated, together, before being
+    evaluated. The few that needed it unexpectedly are interpolated and evaluated again afterwards."""
+    interpolated_mics: List[Optional[float]] = [None] * len(curves)
+    expected = [index for index, curve in enumerate(curves) if fallback_expected(curve, n, mics[index])]
+    for index, mic in zip(expected, mic_interpolated([curves[index].original_curve for index in expected], n)):
+        interpolated_mics[index] = mic
+    fits = _map(evaluate_curve, curves, repeat(n), repeat(closed_form), mics, repeat(plot_points),
+                repeat(diagnostics), interpolated_mics, workers=workers, chunksize=chunksize)
+
+    missed = [index for index, fit in enumerate(fits) if fit.stats["fallback"] and interpolated_mics[index] is None]
+    for index, mic in zip(missed, mic_interpolated([curves[index].original_curve for index in missed], n)):
+        if np.isfinite(mic):
+            fits[index] = evaluate_curve(curves[index], n, closed_form, mics[index], plot_points, diagnostics, mic)
+    return fits
 
-            curve_fitted = None
 
-        if quality == MICQuality.OVER_MEASURED_RANGE:
-            concentration = f"> {max(curve_df.x)} ({100 * max(curve_df.measured) - 100:00.0f}%)"
-        elif quality == MICQuality.UNDER_MEASURED_RANGE:
-            concentration = f"< {min(curve_df.x)} ({100 - 100 * min(curve_df.measured):00.0f}%)"
-        # if mic_error is not None:
-        #    if mic_error.std_dev>mic_error.n*4:
-        #        quality = MICQuality.POOR
-        fits.append(Fit(name, fit_type, MIC(concentration, percentage, quality), curve_df, curve_fitted,
-                        uncertainties={'d0i': _d0i, 'n': _n, 's': _s, 'o': _o, 'mic': mic_error}))
+def curves_from_sourcedata(data: SourceData, exclude: Optional[Container[str]] = None) -> List[Tuple[str, DataFrame]]:
+    """Gather the (name, curve) of each substance, in the order they first appear in `data`, except the
+    names in `exclude`. All the rows of a substance are combined in its curve, points that are not finite
+    are dropped"""
+    curves = []
+
+    concentrations = data.concentrations_array
+    values = data.normalized
+    codes, rows = group_rows_by_name(data.name_codes)
+    for code, substance_rows in zip(codes, rows):
+        substance = data.name_categories[code]
+        if exclude is not None and substance in exclude:
+            continue
+        x = concentrations[substance_rows].ravel()
+        measured = values[substance_rows].ravel()
+        valid = np.isfinite(x) & np.isfinite(measured)
+        curves.append((substance, DataFrame({'x': x[valid], 'measured': measured[valid]})))
+
+    return curves
+
+
+def batch_fit_hill_4p(curve_dfs: List[DataFrame], stats: Optional[List[Dict[str, Any]]] = None,
+                      p0s: Optional[List[Optional[np.ndarray]]] = None) -> List[Any]:
+    """Fit all the curves together with `fit_hill_4p_batch`, curves of the same length are fitted in one go.
+    Gives the same (popt, pcov, function) as `fit_hill_4p` or None for the curves that did not converge.
+    `p0s` can give the starting parameters of each curve, None starts from the middle of the bounds.
+
+    If `stats` is given, it gets the stats of each curve, as for `fit_curve`. The time of a batch is shared
+    equally by its curves"""
+    curves_fitted: List[Any] = [None] * len(curve_dfs)
+    for indices in group_by_length(curve_dfs):
+        x = np.array([curve_dfs[index].x.values for index in indices], dtype=float)
+        measured = np.array([curve_dfs[index].measured.values for index in indices], dtype=float)
+        lower, upper = hill_4p_bounds(x)
+        p0 = (lower + upper) / 2
+        if p0s is not None:
+            for row, index in enumerate(indices):
+                if p0s[index] is not None:
+                    p0[row] = p0s[index]
+        start = perf_counter()
+        popt, pcov, converged, nfev = fit_hill_4p_batch(x, measured, p0)
+        seconds = (perf_counter() - start) / len(indices)
+        for row, index in enumerate(indices):
+            if converged[row]:
+                curves_fitted[index] = (popt[row], pcov[row], hill_4p_function)
+            if stats is not None:
+                stats[index] = {"fit_seconds": seconds, "nfev": int(nfev[row])}
+
+    return curves_fitted
+
+
+def _map(function, *iterables, workers: Optional[int] = None, chunksize: int = 1) -> list:
+    """map, in a pool of `workers` processes if it is not None"""
+    if workers is None:
+        return list(map(function, *iterables))
+
+    with ProcessPoolExecutor(max_workers=workers or None) as executor:
+        return list(executor.map(function, *iterables, chunksize=chunksize))
+
+
+def _cached(cache: FitCache, keys: List[str], items: list, calculate) -> list:
+    """Results of `calculate(items)`, only calculating the items whose key is not in `cache`"""
+    results = [cache.get(key) for key in keys]
+    missing = [index for index, result in enumerate(results) if result is None]
+    for index, result in zip(missing, calculate([items[index] for index in missing])):
+        cache.set(keys[index], result)
+        results[index] = result
+    return results
+
+
+def initial_parameters(curves: List[Tuple[str, DataFrame]], initial_guess: bool = False,
+                       warm_starts: Optional[Dict[str, np.ndarray]] = None) -> Tuple[List[Optional[np.ndarray]],
+                                                                                     List[str]]:
+    """Starting parameters of the fit of each (name, curve) and where they come from: the parameters in
+    `warm_starts` for that name ("warm"), else `hill_4p_initial_guess` with `initial_guess` ("guess"),
+    else None, the middle of the bounds ("default")"""
+    p0s: List[Optional[np.ndarray]] = [None] * len(curves)
+    starts = ["default"] * len(curves)
+    guessed = []
+    for index, (name, curve_df) in enumerate(curves):
+        if warm_starts is not None and name in warm_starts:
+            p0s[index] = np.asarray(warm_starts[name], dtype=float)
+            starts[index] = "warm"
+        elif initial_guess:
+            guessed.append(index)
+            starts[index] = "guess"
+
+    # The guesses of the curves of the same length are estimated together
+    for indices in group_by_length([curve_df for _, curve_df in curves], guessed):
+        guesses = hill_4p_initial_guess([curves[index][1].x.values for index in indices],
+                                        [curves[index][1].measured.values for index in indices])
+        for index, guess in zip(indices, guesses):
+            p0s[index] = guess
+    return p0s, starts
+
+
+def fit_curves(curves: List[Tuple[str, DataFrame]], workers: Optional[int] = None, chunksize: int = 1,
+               batch: bool = False, initial_guess: bool = False,
+               warm_starts: Optional[Dict[str, np.ndarray]] = None) -> List[Curve]:
+    """Fit the Hill 4p function on the (name, curve) given, see `fit_from_sourcedata` for the options.
+    The fits start from the parameters given by `initial_parameters`"""
+    names = [name for name, _ in curves]
+    curve_dfs = [curve_df for _, curve_df in curves]
+    p0s, starts = initial_parameters(curves, initial_guess, warm_starts)
+    stats: List[Dict[str, Any]] = [{} for _ in curves]
+    if batch:
+        curves_fitted = batch_fit_hill_4p(curve_dfs, stats, p0s)
+    else:
+        curves_fitted = [None] * len(curves)
+
+    # Only the curves that are not fitted yet need to go to the processes
+    fitted = [Curve(name, curve_df, FitType.FITTED, curve_fitted, stats=curve_stats)
+              if curve_fitted is not None else None
+              for name, curve_df, curve_fitted, curve_stats in zip(names, curve_dfs, curves_fitted, stats)]
+    missing = [index for index, curve in enumerate(fitted) if curve is None]
+    for index, curve in zip(missing, _map(fit_curve, [names[index] for index in missing],
+                                          [curve_dfs[index] for index in missing], repeat(None),
+                                          [p0s[index] for index in missing],
+                                          workers=workers, chunksize=chunksize)):
+        # The time and evaluations of a failed batch fit are added to those of curve_fit
+        for stat in ("fit_seconds", "nfev"):
+            curve.stats[stat] += stats[index].get(stat, 0)
+        curve.stats["batch_fallback"] = batch
+        fitted[index] = curve
+    for curve, start in zip(fitted, starts):
+        curve.stats["start"] = start
+    return fitted
+
+
+def _bootstrap_chunk(x: np.ndarray, y: np.ndarray, popt: np.ndarray, samples: int, seeds: List) -> List[np.ndarray]:
+    parameters = bootstrap_hill_4p_batch(x, y, popt, samples, seeds)
+    return [curve_parameters[np.isfinite(curve_parameters).all(axis=1)] for curve_parameters in parameters]
+
+
+def bootstrap_curves(curves: List[Curve], samples: int = 200, seed: int = 0, workers: Optional[int] = None,
+                     chunksize: int = 1) -> List[Curve]:
+    """The fitted `curves` with the Hill 4p parameters of `samples` bootstrap samples each (see
+    `bootstrap_hill_4p_batch`), the samples that did not converge are left out. Curves are bootstrapped by
+    chunks of BOOTSTRAP_CHUNK, in a pool of `workers` processes if it is not None.
+
+    The draws of a curve only depend on `seed` and its content, not on the other curves"""
+    chunks = []
+    fitted = [index for index, curve in enumerate(curves) if curve.type_of_fit == FitType.FITTED]
+    for indices in group_by_length([curve.original_curve for curve in curves], fitted):
+        chunks += [indices[start:start + BOOTSTRAP_CHUNK] for start in range(0, len(indices), BOOTSTRAP_CHUNK)]
+
+    xs = [np.array([curves[index].original_curve.x.values for index in chunk], dtype=float) for chunk in chunks]
+    ys = [np.array([curves[index].original_curve.measured.values for index in chunk], dtype=float)
+          for chunk in chunks]
+    popts = [np.array([curves[index].fitted_curve[0] for index in chunk]) for chunk in chunks]
+    seeds = [[[seed, int(curve_key(curves[index].original_curve)[:15], 16)] for index in chunk] for chunk in chunks]
+
+    bootstrapped = list(curves)
+    for chunk, parameters in zip(chunks, _map(_bootstrap_chunk, xs, ys, popts, repeat(samples), seeds,
+                                              workers=workers, chunksize=chunksize)):
+        for index, curve_parameters in zip(chunk, parameters):
+            bootstrapped[index] = replace(curves[index], bootstrap=curve_parameters)
+    return bootstrapped
+
+
+def curve_keys(curves: List[Tuple[str, DataFrame]], dilution_factor: float, batch: bool = False, bootstrap: int = 0,
+               initial_guess: bool = False) -> List[str]:
+    """Keys of the fits of the (name, curve) in a FitCache, they depend on the options of the fit"""
+    # The keys of curves fitted without the options added later are kept as they were before them
+    options = ([bootstrap] if bootstrap > 0 else []) + (["initial guess"] if initial_guess else [])
+    return [curve_key(curve_df, dilution_factor, batch, *options) for _, curve_df in curves]
+
+
+def evaluation_key(key: str, n: float, closed_form: bool = False, diagnostics: bool = False,
+                   piecewise: bool = False) -> str:
+    """Key in a FitCache of the MICn of the curve with the `key`"""
+    return f"{key}:{n!r}:{closed_form}" + (":diagnostics" if diagnostics else "") + (":piecewise" if piecewise else "")
+
+
+def fit_curves_from_sourcedata(data: SourceData, workers: Optional[int] = None, chunksize: int = 1,
+                               batch: bool = False, cache: Optional[FitCache] = None,
+                               fitted: Optional[Dict[str, Curve]] = None, bootstrap: int = 0,
+                               initial_guess: bool = False,
+                               warm_starts: Optional[Dict[str, np.ndarray]] = None) -> List[Curve]:
+    """Fit the Hill 4p function on the curves from `data`, this doesn't depend on the MIC percentage,
+    see `fit_from_sourcedata` for the options.
+
+    `fitted` has curves already fitted by name, they are reused as they are, only the other names are fitted.
+    `warm_starts` has parameters, by name, to start the fit of those substances from (like a previous fit of
+    the same substance). Fits started from them are cached as if they were not."""
+    if fitted is None:
+        fitted = {}
+    def fit(missing: List[Tuple[str, DataFrame]]) -> List[Curve]:
+        missing_curves = fit_curves(missing, workers=workers, chunksize=chunksize, batch=batch,
+                                    initial_guess=initial_guess, warm_starts=warm_starts)
+        if bootstrap > 0:
+            missing_curves = bootstrap_curves(missing_curves, bootstrap, workers=workers, chunksize=chunksize)
+        return missing_curves
+
+    curves = curves_from_sourcedata(data, exclude=fitted)
+    if cache is None:
+        new_curves = fit(curves)
+    else:
+        keys = curve_keys(curves, data.dilution_factor, batch, bootstrap, initial_guess)
+        new_curves = _cached(cache, keys, curves, fit)
+        # The same curve may have been cached under another name
+        new_curves = [replace(curve, name=name, key=key) for curve, (name, _), key in zip(new_curves, curves, keys)]
+
+    if len(fitted) == 0:
+        return new_curves
+    by_name = dict(fitted)
+    by_name.update((curve.name, curve) for curve in new_curves)
+    return [by_name[name] for name in data.name_categories]
+
+
+def evaluate_curves(curves: List[Curve], n: float, workers: Optional[int] = None, chunksize: int = 1,
+                    closed_form: bool = False, cache: Optional[FitCache] = None,
+                    plot_points: int = PLOT_POINTS, diagnostics: bool = False, piecewise: bool = False) -> List[Fit]:
+    """Estimate the MICn of curves already fitted, see `fit_from_sourcedata` for the options.
+    The cache is only used for curves that have a key, as given by `fit_curves_from_sourcedata`"""
+    def evaluate(some_curves: List[Curve]) -> List[Fit]:
+        if closed_form:
+            mics = mic_closed_form([curve.fitted_curve for curve in some_curves], n)
+        else:
+            mics = [None] * len(some_curves)
+        if piecewise:
+            return evaluate_curves_piecewise(some_curves, n, closed_form, mics, plot_points, diagnostics,
+                                             workers=workers, chunksize=chunksize)
+        return _map(evaluate_curve, some_curves, repeat(n), repeat(closed_form), mics, repeat(plot_points),
+                    repeat(diagnostics), workers=workers, chunksize=chunksize)
+
+    if cache is None or any(curve.key is None for curve in curves):
+        return evaluate(curves)
+
+    keys = [evaluation_key(curve.key, n, closed_form, diagnostics, piecewise) for curve in curves]
+    fits = _cached(cache, keys, curves, evaluate)
+    return [fit if fit.name == curve.name else replace(fit, name=curve.name) for fit, curve in zip(fits, curves)]
+
+
+def evaluate_thresholds(curves: List[Curve], ns: List[float], workers: Optional[int] = None, chunksize: int = 1,
+                        closed_form: bool = False, cache: Optional[FitCache] = None,
+                        plot_points: int = PLOT_POINTS, diagnostics: bool = False,
+                        piecewise: bool = False) -> Dict[float, List[Fit]]:
+    """Estimate the MICn of curves already fitted for each n of `ns`, the fits of each n are in the same order as
+    `curves`. See `fit_from_sourcedata` for the options"""
+    return {n: evaluate_curves(curves, n, workers=workers, chunksize=chunksize, closed_form=closed_form, cache=cache,
+                               plot_points=plot_points, diagnostics=diagnostics, piecewise=piecewise)
+            for n in ns}
+
+
+def fit_from_sourcedata(data: SourceData, n: float, workers: Optional[int] = None, chunksize: int = 1,
+                        batch: bool = False, closed_form: bool = False, cache: Optional[FitCache] = None,
+                        plot_points: int = PLOT_POINTS, diagnostics: bool = False, bootstrap: int = 0,
+                        initial_guess: bool = False, piecewise: bool = False) -> List[Fit]:
+    """Fit the curves from `data`, and estimate MICn
+       where n is [0,1]
+
+       If `workers` is given, the substances are fitted in a pool of that many processes
+       (0 uses one per CPU), `chunksize` substances are sent to each process at a time.
+       The fits are returned in the same order in both cases.
 
-    return fits
+       With `batch`, the Hill 4p parameters of all the curves are fitted together with
+       `batch_fit_hill_4p`, the curves it could not fit go through `curve_fit` as usual.
+
+       With `closed_form`, the MICs are calculated by inverting the Hill 4p function
+       instead of searching them with `fsolve` (see `evaluate_curve`).
+
+       If a `cache` is given, only the curves it doesn't know already are fitted.
+
+       Each fit keeps its fitted function sampled on `plot_points` to be plotted, 0 doesn't.
+
+       With `diagnostics`, each fit keeps the outputs of its solvers (see `evaluate_curve`).
+
+       With `piecewise`, the MICs the fits can't give are found on a monotone piecewise cubic
+       interpolation of the points of all the curves needing it at once (see
+       `evaluate_curves_piecewise`) instead of a cubic spline and fsolve for each curve.
+       Replicates are averaged first.
+
+       With `initial_guess`, the fits start from parameters estimated from each curve (see
+       `hill_4p_initial_guess`) instead of the middle of the bounds.
+
+       With `bootstrap` samples, each curve is fitted again on that many residual bootstrap samples (see
+       `bootstrap_curves`), the fits get confidence intervals on the MIC and the parameters.
+    """
+    curves = fit_curves_from_sourcedata(data, workers=workers, chunksize=chunksize, batch=batch, cache=cache,
+                                        bootstrap=bootstrap, initial_guess=initial_guess)
+    return evaluate_curves(curves, n, workers=workers, chunksize=chunksize, closed_form=closed_form, cache=cache,
+                           plot_points=plot_points, diagnostics=diagnostics, piecewise=piecewise)
+
+
+def fit_and_evaluate(name: str, curve_df: Optional[DataFrame], curve: Optional[Curve], ns: List[float],
+                     closed_form: bool = False, plot_points: int = PLOT_POINTS, diagnostics: bool = False,
+                     p0: Optional[np.ndarray] = None, start: str = "default",
+                     piecewise: bool = False) -> Tuple[Curve, List[Fit]]:
+    """Fit the curve of a substance, unless its `curve` is already fitted, and estimate its MICn for each n of
+    `ns`. This is what is done for each substance by `iter_fits_from_sourcedata`"""
+    if curve is None:
+        curve = fit_curve(name, curve_df, p0=p0)
+        curve.stats["start"] = start
+    fits = []
+    for n in ns:
+        mic = mic_closed_form([curve.fitted_curve], n)[0] if closed_form else None
+        if piecewise:
+            fits += evaluate_curves_piecewise([curve], n, closed_form, [mic], plot_points, diagnostics)
+        else:
+            fits.append(evaluate_curve(curve, n, closed_form, mic, plot_points, diagnostics))
+    return curve, fits
+
+
+def _call_chunk(function, tasks: List[tuple]) -> list:
+    return [function(*task) for task in tasks]
+
+
+def _stream(function, tasks: Dict[int, tuple], ready: Dict[int, Any], workers: Optional[int] = None,
+            chunksize: int = 1, ordered: bool = True) -> Iterator[Tuple[int, Any]]:
+    """(index, function(*task)) of each of the `tasks` and (index, result) of the results already `ready`, in the
+    order of the indices with `ordered`, as soon as they are done otherwise.
+
+    With `workers`, the tasks go to a pool of processes by chunks of `chunksize`. Only a few chunks per process
+    are submitted ahead, so the results don't pile up when they are consumed slowly."""
+    ready = dict(ready)
+    if workers is None:
+        for index in sorted(set(tasks) | set(ready)):
+            yield index, ready.pop(index) if index in ready else function(*tasks[index])
+        return
+
+    expected = iter(sorted(set(tasks) | set(ready)))
+    next_index = next(expected, None)
+    if not ordered:
+        yield from sorted(ready.items())
+        ready = {}
+    indices = sorted(tasks)
+    chunks = iter([indices[start:start + chunksize] for start in range(0, len(indices), chunksize)])
+    with ProcessPoolExecutor(max_workers=workers or None) as executor:
+        limit = 2 * (workers or os.cpu_count() or 1)
+        pending = {}
+        try:
+            while True:
+                for chunk in islice(chunks, limit - len(pending)):
+                    pending[executor.submit(_call_chunk, function, [tasks[index] for index in chunk])] = chunk
+                if ordered:
+                    while next_index is not None and next_index in ready:
+                        yield next_index, ready.pop(next_index)
+                        next_index = next(expected, None)
+                if len(pending) == 0:
+                    return
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results = zip(pending.pop(future), future.result())
+                    if ordered:
+                        ready.update(results)
+                    else:
+                        yield from results
+        finally:
+            # When the consumer stops early, the chunks not started yet are dropped
+            for future in pending:
+                future.cancel()
+
+
+def iter_curves_and_fits(data: SourceData, ns: List[float], workers: Optional[int] = None, chunksize: int = 1,
+                         batch: bool = False, closed_form: bool = False, cache: Optional[FitCache] = None,
+                         plot_points: int = PLOT_POINTS, diagnostics: bool = False, bootstrap: int = 0,
+                         initial_guess: bool = False, fitted: Optional[Dict[str, Curve]] = None,
+                         warm_starts: Optional[Dict[str, np.ndarray]] = None, ordered: bool = True,
+                         piecewise: bool = False) -> Iterator[Tuple[int, Curve, List[Fit]]]:
+    """(index, curve, fits) of each substance of `data`, with its index in `data.name_categories` and its fits
+    for each n of `ns`, as soon as they are done. See `iter_fits_from_sourcedata` and
+    `fit_curves_from_sourcedata` for the options.
+
+    Each substance is fitted and evaluated in one go. With `batch` or `bootstrap`, all the curves have to be
+    fitted before any of them is evaluated, only the evaluations are streamed."""
+    if fitted is None:
+        fitted = {}
+    names = data.name_categories
+    curves: List[Optional[Curve]] = [fitted.get(name) for name in names]
+    tasks: Dict[int, tuple] = {}
+    ready: Dict[int, Tuple[Curve, List[Fit]]] = {}
+
+    if batch or bootstrap > 0:
+        curves = fit_curves_from_sourcedata(data, workers=workers, chunksize=chunksize, batch=batch, cache=cache,
+                                            fitted=fitted, bootstrap=bootstrap, initial_guess=initial_guess,
+                                            warm_starts=warm_starts)
+    else:
+        missing = curves_from_sourcedata(data, exclude=fitted)
+        keys = (curve_keys(missing, data.dilution_factor, batch, bootstrap, initial_guess) if cache is not None
+                else [None] * len(missing))
+        p0s, starts = initial_parameters(missing, initial_guess, warm_starts)
+        position = {name: index for index, name in enumerate(names)}
+        for (name, curve_df), key, p0, start in zip(missing, keys, p0s, starts):
+            index = position[name]
+            cached = cache.get(key) if cache is not None else None
+            if cached is not None:
+                curves[index] = replace(cached, name=name, key=key)
+            else:
+                tasks[index] = (name, curve_df, None, ns, closed_form, plot_points, diagnostics, p0, start, piecewise)
+                curves[index] = Curve(name, curve_df, key=key)  # placeholder keeping the key until it is fitted
+
+    for index, curve in enumerate(curves):
+        if index in tasks:
+            continue
+        fits = None
+        if cache is not None and curve.key is not None:
+            fits = [cache.get(evaluation_key(curve.key, n, closed_form, diagnostics, piecewise)) for n in ns]
+        if fits is not None and all(fit is not None for fit in fits):
+            ready[index] = (curve, [fit if fit.name == curve.name else replace(fit, name=curve.name)
+                                    for fit in fits])
+        else:
+            tasks[index] = (curve.name, None, curve, ns, closed_form, plot_points, diagnostics, None, "default",
+                            piecewise)
+
+    for index, (curve, fits) in _stream(fit_and_evaluate, tasks, ready, workers=workers, chunksize=chunksize,
+                                        ordered=ordered):
+        key = curves[index].key
+        if cache is not None and key is not None and index in tasks:
+            if tasks[index][2] is None:
+                curve = replace(curve, key=key)
+                cache.set(key, curve)
+            for n, fit in zip(ns, fits):
+                cache.set(evaluation_key(key, n, closed_form, diagnostics, piecewise), fit)
+        yield index, curve, fits
+
+
+def iter_fits_from_sourcedata(data: SourceData, n: float, workers: Optional[int] = None, chunksize: int = 1,
+                              batch: bool = False, closed_form: bool = False, cache: Optional[FitCache] = None,
+                              plot_points: int = PLOT_POINTS, diagnostics: bool = False, bootstrap: int = 0,
+                              initial_guess: bool = False, ordered: bool = True,
+                              piecewise: bool = False) -> Iterator[Fit]:
+    """The same fits as `fit_from_sourcedata`, yielded as soon as each of them is done instead of all at the end.
+
+    With `ordered`, they come in the order of the substances, otherwise in the order they are done (with
+    `workers`), which gives the first ones sooner. See `fit_from_sourcedata` for the other options."""
+    for _, _, fits in iter_curves_and_fits(data, [n], workers=workers, chunksize=chunksize, batch=batch,
+                                           closed_form=closed_form, cache=cache, plot_points=plot_points,
+                                           diagnostics=diagnostics, bootstrap=bootstrap, initial_guess=initial_guess,
+                                           ordered=ordered, piecewise=piecewise):
+        yield fits[0]
+
+
+async def iterate_async(iterator: Iterator) -> AsyncIterator:
+    """The items of `iterator` as an async iterator, each one is produced in a thread so the event loop
+    keeps running, like: async for fit in iterate_async(iter_fits_from_sourcedata(data, 0.9)): ..."""
+    loop = asyncio.get_running_loop()
+    end = object()
+    while True:
+        item = await loop.run_in_executor(None, next, iterator, end)
+        if item is end:
+            return
+        yield item
@@ -0,0 +1,217 @@
+"""Fitting jobs run in the background, for the web front end
+
+    service = JobService(workers=2)
+    job = service.submit(uploaded_bytes, dilution_factor=2.0)
+    ...  # poll job.status and job.progress until job.finished
+    view = job.view(mic=90, graphics=True)  # results, pages and export for this MIC percentage
+
+A job loads and fits a file, the MIC percentage and the graphics of the export don't change the fits, they only
+change its views.
+"""
+import hashlib
+import io
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Any, Dict, List, Optional
+
+from pandas import DataFrame
+
+from .cache import FitCache
+from .engine import Engine
+
+# Rough memory use, in bytes, used to refuse jobs that are too large before fitting them
+ROW_BYTES = 400  # a row of data, its normalized values and its concentrations
+SUBSTANCE_BYTES = 12000  # the curve and the fits of a substance, with their DataFrames and uncertainties
+PLOT_POINT_BYTES = 8  # each point of the plot curve of a fit
+BOOTSTRAP_SAMPLE_BYTES = 32  # each bootstrap sample of a curve
+PAGE_BYTES = 150000  # a rendered page of graphics
+
+
+class MemoryLimitError(Exception):
+    """A job would need more memory than it is allowed"""
+    pass
+
+
+class JobStatus(Enum):
+    QUEUED = "Queued"
+    LOADING = "Loading"
+    FITTING = "Fitting"
+    EXPORTING = "Exporting"
+    DONE = "Done"
+    FAILED = "Failed"
+
+
+# Views of the results kept by each job, the most recently used ones
+VIEWS_KEPT = 4
+
+
+@dataclass
+class JobView:
+    """Results of a job for a MIC percentage, graphics is whether the export has the graphics"""
+    mic: int
+    graphics: bool
+    results: DataFrame
+    pages: List[bytes]
+    export: bytes
+
+
+@dataclass
+class Job:
+    """A file to fit, and its engine once it is fitted"""
+    key: str
+    parameters: Dict[str, Any]  # see JobService.submit
+    status: JobStatus = JobStatus.QUEUED
+    submitted: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    memory: Optional[int] = None  # estimated memory use in bytes, see estimate_memory
+    substances: int = 0
+    fitted: int = 0  # substances fitted so far
+    engine: Optional[Engine] = None
+    error: Optional[str] = None
+    _views: OrderedDict = field(default_factory=OrderedDict, repr=False, compare=False)
+    _lock: Any = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (JobStatus.DONE, JobStatus.FAILED)
+
+    @property
+    def progress(self) -> float:
+        """Fraction of the job done, from the stage it is in and the substances fitted"""
+        if self.status == JobStatus.FITTING and self.substances > 0:
+            return 0.3 + 0.5 * self.fitted / self.substances
+        return {JobStatus.QUEUED: 0.0, JobStatus.LOADING: 0.1, JobStatus.FITTING: 0.3, JobStatus.EXPORTING: 0.8,
+                JobStatus.DONE: 1.0, JobStatus.FAILED: 1.0}[self.status]
+
+    def view(self, mic: int = 90, graphics: bool = True) -> JobView:
+        """Results, pages and export of the fitted engine for the MIC percentage `mic`. Changing the percentage
+        only estimates the MICs again (see Engine.MICn), the fits are kept. The engine is shared by everyone
+        viewing the job, so the views are made one at a time."""
+        if self.engine is None or self.status not in (JobStatus.EXPORTING, JobStatus.DONE):
+            raise ValueError(f"The job is {self.status.value.lower()}, it has no results")
+        with self._lock:
+            view = self._views.get((mic, graphics))
+            if view is not None:
+                self._views.move_to_end((mic, graphics))
+                return view
+            engine = self.engine
+            engine.MICn = mic
+            from .rendering import render_pages
+
+            # The pages are cached, the export with graphics doesn't render them again
+            pages = render_pages(engine.fits, per_page=engine.fits_per_page)
+            export = io.BytesIO()
+            engine.export_as_spreadsheet(export, graphics=graphics, fits=engine.fits)
+            view = JobView(mic, graphics, engine.export_as_dataframe(), pages, export.getvalue())
+            self._views[(mic, graphics)] = view
+            while len(self._views) > VIEWS_KEPT:
+                self._views.popitem(last=False)
+            return view
+
+
+def job_key(upload: bytes, **parameters) -> str:
+    """Identifies a job by the content of its upload and its parameters"""
+    digest = hashlib.sha256(upload)
+    digest.update(repr(sorted(parameters.items())).encode())
+    return digest.hexdigest()
+
+
+def estimate_memory(engine: Engine) -> int:
+    """Approximate memory in bytes that the fits, the graphics and the export of the data loaded in `engine`
+    will take"""
+    substances = len(engine.data.name_categories)
+    per_substance = (SUBSTANCE_BYTES + 2 * engine.plot_points * PLOT_POINT_BYTES
+                     + engine.bootstrap * BOOTSTRAP_SAMPLE_BYTES) * (1 + len(engine.thresholds))
+    pages = -(-substances // engine.fits_per_page)
+    return engine.data.length * ROW_BYTES + substances * per_substance + pages * PAGE_BYTES * 2
+
+
+class JobService:
+    """Runs jobs in a pool of `workers` threads, the same upload with the same parameters is only fitted once
+
+    Jobs needing more than about `memory_limit` bytes (see estimate_memory) fail instead of being fitted. At most
+    `max_jobs` jobs are kept, the oldest finished ones are forgotten first. All the jobs share the `cache` of fits.
+    Fitting is done in the threads, set `fit_workers` to also spread it over processes (see Engine.workers)."""
+
+    def __init__(self, workers: int = 2, memory_limit: int = 1024 ** 3, max_jobs: int = 32,
+                 cache: Optional[FitCache] = None, fit_workers: Optional[int] = None):
+        self.memory_limit = memory_limit
+        self.max_jobs = max_jobs
+        self.cache = cache
+        self.fit_workers = fit_workers
+        self._jobs: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="itrmicfit-job")
+
+    def submit(self, upload: bytes, dilution_factor: float = 2.0, thresholds: Optional[List[int]] = None,
+               bootstrap: int = 0, mic: Optional[int] = None, graphics: bool = True) -> Job:
+        """The job fitting this upload with these parameters, it is started if it doesn't exist yet or if it failed.
+        If `mic` is given, the view for it and `graphics` is made once the job is fitted (see Job.view), they are
+        not part of the job."""
+        parameters = dict(dilution_factor=dilution_factor, thresholds=list(thresholds or []), bootstrap=bootstrap)
+        key = job_key(upload, **parameters)
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and job.status != JobStatus.FAILED:
+                self._jobs.move_to_end(key)
+                return job
+            job = Job(key, parameters)
+            self._jobs[key] = job
+            self._forget_old_jobs()
+        self._executor.submit(self._run, job, upload, mic, graphics)
+        return job
+
+    def get(self, key: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(key)
+
+    def jobs(self) -> List[Job]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+    def _forget_old_jobs(self):
+        for key in [key for key, job in self._jobs.items() if job.finished][:max(len(self._jobs) - self.max_jobs, 0)]:
+            del self._jobs[key]
+
+    def _run(self, job: Job, upload: bytes, mic: Optional[int], graphics: bool):
+        parameters = job.parameters
+        try:
+            engine = Engine()
+            engine.cache = self.cache
+            engine.workers = self.fit_workers
+            engine.bootstrap = parameters["bootstrap"]
+            engine.thresholds = parameters["thresholds"]
+            engine.onLoadDone = lambda: setattr(job, "status", JobStatus.FITTING)
+            engine.onFitDone = lambda: setattr(job, "status", JobStatus.EXPORTING)
+            job.engine = engine
+
+            job.status = JobStatus.LOADING
+            engine.load_file(io.BytesIO(upload))
+            engine.data.dilution_factor = parameters["dilution_factor"]
+            if mic is not None:
+                engine.MICn = mic
+            job.memory = estimate_memory(engine)
+            if job.memory > self.memory_limit:
+                raise MemoryLimitError(f"The file needs about {job.memory / 1024 ** 2:.0f}MB to be fitted, "
+                                       f"more than the {self.memory_limit / 1024 ** 2:.0f}MB allowed")
+            job.substances = len(engine.data.name_categories)
+            for _ in engine.iter_fit(ordered=False):
+                job.fitted += 1
+
+            if mic is not None:
+                job.view(mic, graphics)
+            job.finished_at = time.time()
+            job.status = JobStatus.DONE
+        except Exception as error:
+            job.error = "".join(traceback.format_exception_only(type(error), error)).strip()
+            job.engine = None
+            job.finished_at = time.time()
+            job.status = JobStatus.FAILED
@@ -1,21 +1,20 @@
 import numpy as np
-from typing import List
-from matplotlib.figure import Figure
-import matplotlib.pyplot as plt
-from .fitting import Fit, FitType, MICQuality, interpolate_curve_df_and_fitted
+from typing import TYPE_CHECKING, List
+from .fitting import Fit, FitType, MICQuality, fitted_plot_curve
+
+if TYPE_CHECKING:
+    from matplotlib.figure import Figure
 
 
 def plot_to_file(self, file, elements):
+    import matplotlib.pyplot as plt
+
     fig = plt.figure(1, (10, 5), tight_layout=True)
     plot(elements, fig=fig)
     fig.savefig(file, dpi=600)
 
 
-def plot(data: List[Fit], fig: Figure):
-    curve_interpolated = None
-    hmax = None
-    mic_title = ""
-
+def plot(data: List[Fit], fig: "Figure"):
     nb = np.min([2, len(data)])
     no = (len(data) + 1) // 2
     ax = fig.subplots(nb, no)
@@ -26,12 +25,19 @@ def plot(data: List[Fit], fig: Figure):
             axis = ax
         else:
             axis = ax.flatten()[index]
+        hmax = None
+        mic_title = ""
+        x_max = fit.original_curve.x.max()
 
-        fit.original_curve.plot(x='x', y=['measured'], kind='scatter', c='red', ax=axis)
-        curve_fitted = fit.fitted_curve
-        if curve_fitted is not None:
-            curve_interpolated = interpolate_curve_df_and_fitted(fit.original_curve, curve_fitted)
-            curve_interpolated.plot(x='x', y=['fitted'], ax=axis)
+        axis.scatter(fit.original_curve.x.values, fit.original_curve.measured.values, s=20, c='red')
+        if fit.fitted_curve is not None:
+            # Fits made without a plot curve (headless) get one on the fly
+            if fit.plot_curve is not None:
+                x, fitted = fit.plot_curve
+            else:
+                x, fitted = fitted_plot_curve(fit.original_curve, fit.fitted_curve)
+            axis.plot(x, fitted, label='fitted')
+            axis.legend()
         background = "#FFFFFF"
         mic_line_color = None
         if fit.type_of_fit == FitType.NOT_FITTED:
@@ -51,33 +57,30 @@ def plot(data: List[Fit], fig: Figure):
                 mic_line_color = "#A08000"
                 background = "#FFAFAF"
                 if not isinstance(fit.mic.concentration, str) and fit.mic.concentration is not None:
-                    if curve_interpolated is not None:
-                        hmax = np.max((fit.mic.concentration, curve_interpolated.x.max()))
+                    if fit.fitted_curve is not None:
+                        hmax = np.max((fit.mic.concentration, x_max))
                     else:
                         hmax = fit.mic.concentration
-                        print(hmax)
                 else:
-                    hmax = fit.original_curve.x.max()
+                    hmax = x_max
             elif fit.mic.quality == MICQuality.OK:
                 background = "#AFFFAF"
                 mic_line_color = "#004F00"
-                hmax = np.max((fit.mic.concentration, curve_interpolated.x.max()))
+                hmax = np.max((fit.mic.concentration, x_max))
             elif fit.mic.quality == MICQuality.POOR:
                 background = "#DFFFAF"
                 mic_line_color = "#00FF00"
                 if isinstance(fit.mic.concentration, np.float64):
-                    hmax = np.max((fit.mic.concentration, curve_interpolated.x.max()))
+                    hmax = np.max((fit.mic.concentration, x_max))
                 elif fit.mic.concentration.isnumeric():
-                    print(fit.mic.concentration)
-                    print(curve_interpolated.x.max())
-                    hmax = np.max((fit.mic.concentration, curve_interpolated.x.max()))
+                    hmax = np.max((fit.mic.concentration, x_max))
                 else:
-                    hmax = curve_interpolated.x.max()
+                    hmax = x_max
             elif fit.mic.quality == MICQuality.ESTIMATED_FROM_INTERPOLATION:
                 background = "#FFE0A0"
                 mic_title += f" - Estimated from interpolation"
                 mic_line_color = "#A0FF00"
-                hmax = np.max(fit.original_curve.x.max())
+                hmax = x_max
             else:
                 background = "#FFA0A0"
                 mic_title += " - Cannot find an MIC"
@@ -87,7 +90,6 @@ def plot(data: List[Fit], fig: Figure):
             if isinstance(fit.mic.concentration, np.float64):
                 axis.vlines(fit.mic.concentration, 0, 1, color=mic_line_color)
         if hmax is not None:
-            print(fit.mic.percentage)
             axis.hlines(1 - fit.mic.percentage, 0, hmax, color="#004F00")
 
         axis.set_title(f"{fit.name} {mic_title}")
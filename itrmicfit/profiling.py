@@ -0,0 +1,114 @@
+import json
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+from pandas import DataFrame
+
+from .fitting import Curve, Fit, FitType
+
+STAGES = ["parse", "normalize", "fit", "solve", "spline fallback", "export", "plot"]
+
+
+@dataclass
+class CompoundProfile:
+    """Where the time went for one substance"""
+    name: str
+    fitted: bool
+    fit_seconds: float = 0.0
+    nfev: int = 0  # function evaluations of the fit
+    batch_fallback: bool = False  # the batch fit failed and curve_fit was used
+    start: str = "default"  # where the fit started from, see fitting.initial_parameters
+    solve_seconds: float = 0.0
+    spline_seconds: float = 0.0
+    spline_fallback: bool = False  # the MIC comes from the cubic spline interpolation
+
+
+def compound_profile(curve: Curve, fit: Fit) -> CompoundProfile:
+    """The stats of a fitted `curve` and of its `fit`"""
+    return CompoundProfile(curve.name, curve.type_of_fit == FitType.FITTED,
+                           fit_seconds=curve.stats.get("fit_seconds", 0.0),
+                           nfev=curve.stats.get("nfev", 0),
+                           batch_fallback=curve.stats.get("batch_fallback", False),
+                           start=curve.stats.get("start", "default"),
+                           solve_seconds=fit.stats.get("solve_seconds", 0.0),
+                           spline_seconds=fit.stats.get("spline_seconds", 0.0),
+                           spline_fallback=fit.stats.get("fallback", False))
+
+
+@dataclass
+class Report:
+    """Timings of the stages of an Engine and of each substance
+
+    `stages` has the time in seconds of the last run of each stage (see STAGES). "spline fallback" is the total
+    time spent in the spline interpolations of all the substances, it is part of "solve", as "plot" is part of
+    "export". Compounds fitted in worker processes are timed there, so with workers the times of the compounds
+    add up to more than their stage. Fits coming from a cache keep the stats of when they were calculated.
+
+    `sink`, if given, is called with the name of each stage and the report when the stage is done."""
+    stages: Dict[str, float] = field(default_factory=dict)
+    compounds: List[CompoundProfile] = field(default_factory=list)
+    sink: Optional[Callable[[str, "Report"], None]] = None
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        yield
+        self.stages[name] = time.perf_counter() - start
+        self.emit(name)
+
+    def emit(self, name: str):
+        if self.sink is not None:
+            self.sink(name, self)
+
+    def record_compounds(self, curves: List[Curve], fits: List[Fit]):
+        """Keep the stats of the fitted `curves` and of their `fits`, in the same order"""
+        self.record_profiles([compound_profile(curve, fit) for curve, fit in zip(curves, fits)])
+
+    def record_profiles(self, compounds: List[CompoundProfile]):
+        """Keep the stats of the `compounds`, see compound_profile"""
+        self.compounds = compounds
+        self.stages["spline fallback"] = sum(compound.spline_seconds for compound in self.compounds)
+        self.emit("spline fallback")
+
+    @property
+    def nfev(self) -> int:
+        return sum(compound.nfev for compound in self.compounds)
+
+    def rate(self, attribute: str) -> float:
+        """Fraction of the compounds for which `attribute` of CompoundProfile is true"""
+        if len(self.compounds) == 0:
+            return 0.0
+        return sum(bool(getattr(compound, attribute)) for compound in self.compounds) / len(self.compounds)
+
+    def to_dataframe(self) -> DataFrame:
+        """One row per compound"""
+        return DataFrame([asdict(compound) for compound in self.compounds],
+                         columns=list(CompoundProfile.__dataclass_fields__))
+
+    def slowest(self, count: int = 10) -> DataFrame:
+        """The `count` compounds that took the longest to fit and solve"""
+        df = self.to_dataframe()
+        df["seconds"] = df.fit_seconds + df.solve_seconds
+        return df.sort_values("seconds", ascending=False).head(count)
+
+    def summary(self) -> Dict[str, Any]:
+        return {"stages": dict(self.stages),
+                "compounds": len(self.compounds),
+                "not fitted rate": 1 - self.rate("fitted") if len(self.compounds) > 0 else 0.0,
+                "nfev": self.nfev,
+                "batch fallback rate": self.rate("batch_fallback"),
+                "spline fallback rate": self.rate("spline_fallback")}
+
+
+class JSONLinesSink:
+    """Sink appending a JSON line to `path` for each stage, with the summary of the report"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def __call__(self, stage: str, report: Report):
+        with open(self.path, "a") as file:
+            file.write(json.dumps({"time": time.time(), "stage": stage, "seconds": report.stages.get(stage),
+                                   **report.summary()}) + "\n")
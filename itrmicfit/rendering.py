@@ -0,0 +1,71 @@
+import hashlib
+import io
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+from .cache import FitCache, curve_key
+from .fitting import Fit
+from .plotting import plot
+
+FITS_PER_PAGE = 8
+PAGE_SIZE = (20, 10)  # in inches, the fits of a page are on two rows
+DPI = 100
+
+page_cache = FitCache(maxsize=256)  # default cache of the rendered pages
+
+
+def paginate(fits: List[Fit], per_page: int = FITS_PER_PAGE) -> List[List[Fit]]:
+    return [fits[start:start + per_page] for start in range(0, len(fits), per_page)]
+
+
+def fit_key(fit: Fit) -> str:
+    """Key identifying everything about a fit that shows on its plot"""
+    parameters = None if fit.fitted_curve is None else tuple(fit.fitted_curve[0])
+    return curve_key(fit.original_curve, fit.name, fit.type_of_fit.value, str(fit.mic.concentration),
+                     fit.mic.percentage, fit.mic.quality.value, parameters)
+
+
+def page_key(fits: List[Fit], size: Tuple[float, float] = PAGE_SIZE, dpi: int = DPI) -> str:
+    digest = hashlib.sha256(repr((size, dpi)).encode())
+    for fit in fits:
+        digest.update(fit_key(fit).encode())
+    return digest.hexdigest()
+
+
+def render_page(fits: List[Fit], size: Tuple[float, float] = PAGE_SIZE, dpi: int = DPI) -> bytes:
+    """PNG of the plots of `fits`, rendered with Agg so it can run in any thread or process"""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=size, tight_layout=True)
+    FigureCanvasAgg(fig)
+    plot(fits, fig=fig)
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=dpi)
+    return buf.getvalue()
+
+
+def render_pages(fits: List[Fit], per_page: int = FITS_PER_PAGE, size: Tuple[float, float] = PAGE_SIZE,
+                 dpi: int = DPI, workers: Optional[int] = None,
+                 cache: Optional[FitCache] = page_cache) -> List[bytes]:
+    """PNG of each page of `per_page` fits. Pages are rendered in a pool of `workers` processes if it is not None
+    (0 uses one per CPU). Pages with the same fits are only rendered once when `cache` is given."""
+    pages = paginate(fits, per_page)
+    keys = [page_key(page, size, dpi) for page in pages]
+    images = [cache.get(key) if cache is not None else None for key in keys]
+    missing = [index for index, image in enumerate(images) if image is None]
+    missing_pages = [pages[index] for index in missing]
+    sizes = [size] * len(missing)
+    dpis = [dpi] * len(missing)
+
+    if workers is None or len(missing) < 2:
+        rendered = map(render_page, missing_pages, sizes, dpis)
+    else:
+        with ProcessPoolExecutor(max_workers=workers or None) as executor:
+            rendered = list(executor.map(render_page, missing_pages, sizes, dpis))
+
+    for index, image in zip(missing, rendered):
+        images[index] = image
+        if cache is not None:
+            cache.set(keys[index], image)
+    return images
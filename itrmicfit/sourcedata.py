@@ -1,68 +1,164 @@
-from pandas import DataFrame
-from numpy import nan, newaxis, array, arange
-from math import isnan
-from typing import List
+import copy
+from pandas import DataFrame, factorize, to_numeric
+from typing import List, Optional, Set, Tuple
+import numpy as np
+
+NPZ_VERSION = 1  # version of the format written by SourceData.save
+MEASURED_COLUMNS = ["blank", '0', '1', '2', '3', '4', '5', '6', '7', '8', "bacterial_control", "blank2"]
+
+
+def encode_names(names) -> Tuple[np.ndarray, List[str]]:
+    """Integer codes of `names` and the names they stand for, in the order they first appear.
+    Names are compared as strings, like they are displayed"""
+    codes, uniques = factorize(np.asarray(names, dtype=object), sort=False, use_na_sentinel=False)
+    # Different values can give the same string (1 and "1")
+    string_codes, categories = factorize(np.array([str(name) for name in uniques], dtype=object), sort=False)
+    return string_codes[codes].astype(np.int32), list(categories)
 
 
 class SourceData:
-    """Container for original data and their normalization"""
-    data: DataFrame
+    """Container for original data and their normalization
+
+    The data is kept in arrays: `values` has the 12 MEASURED_COLUMNS of each row, `name_codes` the code of the
+    name of each row in `name_categories` and `initial_concentrations` the initial concentration of each row.
+    The DataFrames (`data`, `concentrations` and `values_normalized`) are only built when they are asked for.
+
+    Data appended with `append` is kept in chunks, the arrays are only concatenated when they are needed."""
     dilution_factor: float = 2.0
-    initial_concentrations: List[float]
-    names: List[str]
-    concentrations: DataFrame = None
-    values_normalized: DataFrame = None
+    name_categories: List[str]
+    normalized: Optional[np.ndarray] = None  # (rows, 9) normalized values, set by calculate
     valid_cols: List[str]
 
-    def __init__(self, data):
-        self.data = data
-        self.initial_concentrations = [1]*len(self.data)
-        self.gather_names()
-        self.gather_concentrations()
+    def __init__(self, data: DataFrame):
+        """From a DataFrame with the MEASURED_COLUMNS, "name" and "initial_concentration".
+        Initial concentrations that are missing or not numbers are 1"""
+        initial_concentrations = to_numeric(data['initial_concentration'], errors='coerce').to_numpy(dtype=float)
+        self._set_arrays(data[MEASURED_COLUMNS].to_numpy(dtype=float), *encode_names(data['name'].values),
+                         np.where(np.isnan(initial_concentrations), 1.0, initial_concentrations))
+
+    @classmethod
+    def from_arrays(cls, values: np.ndarray, names, initial_concentrations: np.ndarray) -> "SourceData":
+        """From the (rows, 12) `values` of the MEASURED_COLUMNS, the names and initial concentrations of the rows"""
+        source = cls.__new__(cls)
+        initial_concentrations = np.asarray(initial_concentrations, dtype=float)
+        source._set_arrays(np.asarray(values, dtype=float), *encode_names(names),
+                           np.where(np.isnan(initial_concentrations), 1.0, initial_concentrations))
+        return source
+
+    def _set_arrays(self, values: np.ndarray, name_codes: np.ndarray, name_categories: List[str],
+                    initial_concentrations: np.ndarray):
+        self._chunks = [(values, name_codes, initial_concentrations)]
+        self.name_categories = name_categories
+        self._name_index = {name: code for code, name in enumerate(name_categories)}
+        self.normalized = None
         self.valid_cols = ['0', '1', '2', '3', '4', '5', '6', '7', '8']
 
+    def append(self, other: "SourceData") -> Set[str]:
+        """Add the rows of `other` after the ones of this data, without copying anything yet.
+        Returns the names of the rows added, the normalization has to be calculated again"""
+        codes = []
+        for name in other.name_categories:
+            if name not in self._name_index:
+                self._name_index[name] = len(self.name_categories)
+                self.name_categories.append(name)
+            codes.append(self._name_index[name])
+        recode = np.array(codes, dtype=np.int32)
+        for values, name_codes, initial_concentrations in other._chunks:
+            self._chunks.append((values, recode[name_codes], initial_concentrations))
+        self.normalized = None
+        return set(other.name_categories)
+
+    def _consolidated(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        if len(self._chunks) > 1:
+            self._chunks = [tuple(np.concatenate(arrays) for arrays in zip(*self._chunks))]
+        return self._chunks[0]
+
+    def with_dilution_factor(self, dilution_factor: float) -> "SourceData":
+        """The same data with another dilution factor, the arrays and the normalized values are shared, not copied"""
+        self._consolidated()
+        source = copy.copy(self)
+        source._chunks = list(self._chunks)
+        source.name_categories = list(self.name_categories)
+        source._name_index = dict(self._name_index)
+        source.dilution_factor = dilution_factor
+        return source
+
+    @property
+    def values(self) -> np.ndarray:
+        """(rows, 12) values of the MEASURED_COLUMNS"""
+        return self._consolidated()[0]
+
+    @property
+    def name_codes(self) -> np.ndarray:
+        return self._consolidated()[1]
+
+    @property
+    def initial_concentrations(self) -> np.ndarray:
+        return self._consolidated()[2]
+
     @property
     def length(self):
-        return len(self.data)
-
-    def gather_names(self):
-        if len(self.data['name'].values) > 0:
-            self.names = self.data['name'].apply(str).replace(nan, '').values
-            self.reset_names()
-
-    def gather_concentrations(self):
-        if len(self.data['initial_concentration'].values) > 0:
-            concentrations = []
-            for i in self.data['initial_concentration'].values:
-                if isnan(i):
-                    concentrations.append(1.0)
-                else:
-                    try:
-                        concentrations.append(float(i))
-                    except ValueError:
-                        concentrations.append(1.0)
-            self.initial_concentrations = concentrations
-
-    def reset_names(self):
-        if self.concentrations is not None:
-            self.concentrations['name'] = self.names
-        if self.values_normalized is not None:
-            self.values_normalized['name'] = self.names
-        self.data['name'] = self.names
+        return sum(len(values) for values, _, _ in self._chunks)
 
-    def calculate(self):
-        source_df = self.data
+    @property
+    def names(self) -> np.ndarray:
+        """Name of each row"""
+        return np.array(self.name_categories, dtype=object)[self.name_codes]
 
-        # Blanks are used from the whole plate
-        blank = (source_df['blank'] + source_df['blank2']) / 2
+    @property
+    def concentrations_array(self) -> np.ndarray:
+        """(rows, 9) concentrations of the values"""
+        return self.initial_concentrations[:, np.newaxis] / self.dilution_factor ** np.arange(0, 9, 1)
+
+    @property
+    def data(self) -> DataFrame:
+        """The original data, with the Engine.DEFAULT_COLUMNS"""
+        data = DataFrame(self.values, columns=MEASURED_COLUMNS)
+        data['name'] = self.names
+        data['initial_concentration'] = self.initial_concentrations
+        return data
+
+    @property
+    def concentrations(self) -> Optional[DataFrame]:
+        if self.normalized is None:
+            return None
+        concentrations = DataFrame(self.concentrations_array)
+        concentrations['name'] = self.names
+        return concentrations
 
-        data = source_df[self.valid_cols]
+    @property
+    def values_normalized(self) -> Optional[DataFrame]:
+        if self.normalized is None:
+            return None
+        values_normalized = DataFrame(self.normalized, columns=self.valid_cols)
+        values_normalized['name'] = self.names
+        return values_normalized
+
+    def calculate(self):
+        # Blanks are used from the whole plate
+        blank = (self.values[:, 0] + self.values[:, 11]) / 2
+        self.normalized = (self.values[:, 1:10] - blank[:, np.newaxis]) / (self.values[:, 10] - blank)[:, np.newaxis]
 
-        self.values_normalized = (data.sub(blank, axis='rows')).div(
-            source_df['bacterial_control'].sub(blank, axis='rows'), axis='rows')
+    def save(self, file):
+        """Save the data, and the normalized values if they are calculated, in a numpy .npz file (a path or a binary
+        file object). Loading it with `load` is much faster than parsing the spreadsheet again."""
+        arrays = {"version": NPZ_VERSION,
+                  "values": self.values,
+                  "names": np.asarray(self.names, dtype=str),
+                  "initial_concentrations": self.initial_concentrations,
+                  "dilution_factor": self.dilution_factor}
+        if self.normalized is not None:
+            arrays["values_normalized"] = self.normalized
+        np.savez(file, **arrays)
 
-        dilution_factors = self.dilution_factor ** (arange(0, 9, 1))
-        self.concentrations = DataFrame(array(self.initial_concentrations)[:, newaxis] / dilution_factors)
-        self.reset_names()
-        self.concentrations.index = self.values_normalized.index
-        self.data.index = self.values_normalized.index
+    @classmethod
+    def load(cls, file) -> "SourceData":
+        """Data saved with `save`"""
+        with np.load(file, allow_pickle=False) as npz:
+            if int(npz["version"]) > NPZ_VERSION:
+                raise ValueError(f"The data was saved by a newer version (format {int(npz['version'])})")
+            source = cls.from_arrays(npz["values"], npz["names"], npz["initial_concentrations"])
+            source.dilution_factor = float(npz["dilution_factor"])
+            if "values_normalized" in npz.files:
+                source.normalized = npz["values_normalized"]
+        return source
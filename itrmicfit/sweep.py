@@ -0,0 +1,104 @@
+"""Analysis of one plate under several dilution factors and MIC percentages
+
+    engine.load_file(path)  # parsed once
+    results = engine.sweep(dilution_factors=[2, 3], percentages=[50, 80, 90])
+
+The values are normalized once, they don't depend on the dilution factor. The curves are fitted once per dilution
+factor, they don't depend on the MIC percentage, and the MICs of all the dilution factors are estimated together
+for each percentage. The result is one row per dilution factor, MIC percentage and substance.
+"""
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from .cache import FitCache
+from .fitting import Curve, Fit, FitType, evaluate_curves, fit_curves_from_sourcedata
+from .sourcedata import SourceData
+
+SWEEP_COLUMNS = ["dilution factor", "mic percentage", "name", "type of fit", "mic concentration", "mic quality",
+                 "hill4p_d0i", "hill4p_n", "hill4p_s", "hill4p_o"]
+# Confidence intervals of the bootstrap, by name in the intervals of a fit and name of their columns
+INTERVAL_COLUMNS = {"mic": "mic", "d0i": "hill4p_d0i", "n": "hill4p_n", "s": "hill4p_s", "o": "hill4p_o"}
+
+
+def rescale_dilution(parameters: np.ndarray, first_concentration: float, dilution_factor: float,
+                     new_dilution_factor: float) -> np.ndarray:
+    """Hill 4p parameters (d0i, n, s, o) of the same curve with its concentrations calculated with another
+    dilution factor. The concentrations go from `first_concentration` down, the growth at each dilution doesn't
+    change, so in log scale the curve is only stretched around the first concentration."""
+    d0i, n, s, o = parameters[:4]
+    ratio = np.log(dilution_factor) / np.log(new_dilution_factor)
+    return np.array([first_concentration * (d0i / first_concentration) ** (1 / ratio), n * ratio, s, o])
+
+
+def warm_starts_from(curves: List[Curve], dilution_factor: float, new_dilution_factor: float) -> Dict[str, np.ndarray]:
+    """Starting parameters, by name, for the fits of `curves` under another dilution factor.
+    This is exact for substances that have a single initial concentration."""
+    if dilution_factor <= 1 or new_dilution_factor <= 1:
+        return {}
+    return {curve.name: rescale_dilution(curve.fitted_curve[0], curve.original_curve.x.max(), dilution_factor,
+                                         new_dilution_factor)
+            for curve in curves if curve.type_of_fit == FitType.FITTED}
+
+
+def sweep_rows(dilution_factor: float, fits: List[Fit]) -> List[dict]:
+    rows = []
+    for fit in fits:
+        parameters = fit.fitted_curve[0][:4] if fit.fitted_curve is not None else [None] * 4
+        row = {"dilution factor": dilution_factor,
+               "mic percentage": int(round(fit.mic.percentage * 100)),
+               "name": fit.name,
+               "type of fit": fit.type_of_fit.value,
+               "mic concentration": fit.mic.concentration,
+               "mic quality": fit.mic.quality.value,
+               **dict(zip(SWEEP_COLUMNS[6:], parameters))}
+        intervals = fit.uncertainties.get("ci")
+        if intervals is not None:
+            for name, column in INTERVAL_COLUMNS.items():
+                row[f"{column} ci low"], row[f"{column} ci high"] = intervals.get(name) or (None, None)
+        rows.append(row)
+    return rows
+
+
+def sweep(data: SourceData, dilution_factors: List[float], percentages: List[int], workers: Optional[int] = None,
+          chunksize: int = 1, batch: bool = False, closed_form: bool = False, cache: Optional[FitCache] = None,
+          bootstrap: int = 0, initial_guess: bool = False, warm_start: bool = True,
+          plot_points: int = 0, piecewise: bool = False) -> pd.DataFrame:
+    """MICs of the substances of `data` for each dilution factor and MIC percentage (0-100) of the grid, in a
+    DataFrame with the SWEEP_COLUMNS (and the confidence intervals with `bootstrap`), in the order of the grid.
+
+    The curves of the first dilution factor are fitted as usual. With `warm_start`, the fits of the other dilution
+    factors start from those parameters rescaled to them (see `rescale_dilution`), they converge in a few steps.
+    The fits of each dilution factor, and the MICs of each percentage for all the dilution factors together, are
+    spread over `workers` processes. See `fit_from_sourcedata` for the other options, nothing is plotted by
+    default."""
+    if data.normalized is None:
+        data.calculate()
+
+    curves_by_dilution: List[List[Curve]] = []
+    for dilution_factor in dilution_factors:
+        warm_starts = None
+        if warm_start and len(curves_by_dilution) > 0:
+            warm_starts = warm_starts_from(curves_by_dilution[0], dilution_factors[0], dilution_factor)
+        curves_by_dilution.append(fit_curves_from_sourcedata(data.with_dilution_factor(dilution_factor),
+                                                             workers=workers, chunksize=chunksize, batch=batch,
+                                                             cache=cache, bootstrap=bootstrap,
+                                                             initial_guess=initial_guess, warm_starts=warm_starts))
+
+    all_curves = [curve for curves in curves_by_dilution for curve in curves]
+    rows_by_point: Dict[tuple, List[dict]] = {}
+    for percentage in percentages:
+        fits = evaluate_curves(all_curves, percentage / 100, workers=workers, chunksize=chunksize,
+                               closed_form=closed_form, cache=cache, plot_points=plot_points, piecewise=piecewise)
+        start = 0
+        for dilution_factor, curves in zip(dilution_factors, curves_by_dilution):
+            rows_by_point[(dilution_factor, percentage)] = sweep_rows(dilution_factor, fits[start:start + len(curves)])
+            start += len(curves)
+
+    rows = [row for dilution_factor in dilution_factors for percentage in percentages
+            for row in rows_by_point[(dilution_factor, percentage)]]
+    columns = list(SWEEP_COLUMNS)
+    if bootstrap > 0:
+        columns += [f"{column} ci {bound}" for column in INTERVAL_COLUMNS.values() for bound in ("low", "high")]
+    return pd.DataFrame(rows, columns=columns)
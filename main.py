@@ -1,10 +1,23 @@
+import time
 import streamlit as st
-import itrmicfit.engine as imf_engine
-import itrmicfit.plotting as imf_plotting
-from matplotlib.figure import Figure
-import tempfile
+from itrmicfit.cache import FitCache
+from itrmicfit.jobs import JobService, JobStatus
 
 st.set_page_config(layout="wide")
+
+
+@st.cache_resource
+def fit_cache():
+    """Shared by all the sessions, so the same curves are never fitted twice"""
+    return FitCache()
+
+
+@st.cache_resource
+def job_service():
+    """Files are fitted in the background, by a few threads shared by all the sessions"""
+    return JobService(cache=fit_cache())
+
+
 st.header("ITR MIC Fit")
 st.write("""
 You can upload an XLS(x) file from the plate reader. And it will calculate the MICs for you.
@@ -43,13 +56,27 @@ uploaded_file = st.file_uploader("Choose a XLS file formatted properly for this
 
 mic_value = st.number_input("MIC percentage to fit", value=90, min_value=1, max_value=99)
 dilution_factor = st.number_input("Dilution factor", value=2.0, min_value=1.1, max_value=100.0)
+bootstrap = st.number_input("Bootstrap samples for confidence intervals (0 for none)", value=0, min_value=0,
+                            max_value=5000)
+graphics = st.checkbox("Export graphics", value=True)
 
 if uploaded_file is not None:
-    engine = imf_engine.Engine()
-    engine.load_file(uploaded_file)
-    engine.data.dilution_factor = dilution_factor
-    engine.MICn = mic_value
-    engine.fit()
+    # The same file with the same parameters is only fitted once, the job is polled until it is done.
+    # The MIC percentage and the graphics are not part of the job, changing them doesn't fit again.
+    job = job_service().submit(uploaded_file.getvalue(), dilution_factor=dilution_factor, bootstrap=bootstrap,
+                               mic=mic_value, graphics=graphics)
+    if not job.finished:
+        text = job.status.value
+        if job.status == JobStatus.FITTING and job.substances > 0:
+            text += f" ({job.fitted}/{job.substances} substances)"
+        st.progress(job.progress, text=text)
+        time.sleep(0.5)
+        st.rerun()
+    if job.status == JobStatus.FAILED:
+        st.error(job.error)
+        st.stop()
+    engine = job.engine
+    view = job.view(mic_value, graphics)
 
     with st.expander("Source data"):
         st.dataframe(engine.data.data)
@@ -70,13 +97,12 @@ if uploaded_file is not None:
                 )
 
 
-    figure = Figure(figsize=(20, 20), tight_layout=True)
-    imf_plotting.plot(engine.fits, figure)
-    st.pyplot(figure)
+    for page in view.pages:
+        st.image(page)
 
     st.header("Tables")
 
-    out = engine.export_as_dataframe()
+    out = view.results.copy()
     out.index = out.name
 
     # dicts are ordered now, so we can just make a dict and we should keep the keys in order
@@ -84,9 +110,4 @@ if uploaded_file is not None:
     ordered_unique_names = list(dict.fromkeys(engine.data.names))
     st.dataframe(out.loc[ordered_unique_names, ~(out.columns == "name")])
 
-    graphics = st.checkbox("Export graphics", value=True)
-    temp_file = tempfile.NamedTemporaryFile()
-    out = engine.export_as_spreadsheet(temp_file.name, graphics=graphics, fits=engine.fits)
-    st.download_button("Export table", data=temp_file.read(), file_name="export.xlsx")
-    temp_file.delete = True
-    temp_file.close()
+    st.download_button("Export table", data=view.export, file_name="export.xlsx")